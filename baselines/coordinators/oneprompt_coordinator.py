@@ -18,7 +18,7 @@ from baselines.templates.oneprompt_templates import (
     oneprompt_prompt_template,
     OnePromptResponse,
 )
-from sage.testing.fake_requests import db as test_log_db
+from sage.testing.fake_requests import get_test_logs_db
 
 
 @dataclass
@@ -54,7 +54,7 @@ class OnePromptCoordinator(BaseCoordinator):
 
         user_name, command = command.split(":")
         device_state = deepcopy(
-            test_log_db.get_device_state(self.config.global_config.test_id)
+            get_test_logs_db().get_device_state(self.config.global_config.test_id)
         )
 
         parser = PydanticOutputParser(pydantic_object=OnePromptResponse)
@@ -70,7 +70,7 @@ class OnePromptCoordinator(BaseCoordinator):
         if bool(planning_answer.diff):
             if "devices" in planning_answer.diff:
                 device_state.update(planning_answer.diff["devices"])
-                test_log_db.set_device_state(
+                get_test_logs_db().set_device_state(
                     self.config.global_config.test_id, device_state
                 )
 
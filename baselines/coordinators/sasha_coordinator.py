@@ -13,7 +13,7 @@ from langchain.output_parsers import PydanticOutputParser
 
 from sage.coordinators.base import CoordinatorConfig, BaseCoordinator
 from sage.utils.llm_utils import TGIConfig
-from sage.testing.fake_requests import db as test_log_db
+from sage.testing.fake_requests import get_test_logs_db
 from baselines.templates.multistage_sasha_templates import (
     ClarificationResponse,
     FilteringResponse,
@@ -147,7 +147,7 @@ class SashaCoordinator(BaseCoordinator):
         chain_dict = self.get_chain()
 
         device_state = deepcopy(
-            test_log_db.get_device_state(self.config.global_config.test_id)
+            get_test_logs_db().get_device_state(self.config.global_config.test_id)
         )
 
         new_device_state = self.get_state_descriptions(device_state)
@@ -194,7 +194,7 @@ class SashaCoordinator(BaseCoordinator):
                 # update state in database
 
                 device_state.update(planning_answer["devices"])
-                test_log_db.set_device_state(
+                get_test_logs_db().set_device_state(
                     self.config.global_config.test_id, device_state
                 )
 
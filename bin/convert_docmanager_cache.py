@@ -0,0 +1,19 @@
+"""
+Script to convert a DocManager cache between the JSON and the binary (pickle) formats.
+The format is given by the suffix of the paths (.json or .pkl). JSON is the default; to use the
+binary cache, point GlobalConfig.docmanager_cache_path to the converted file and keep the JSON file
+next to it: the binary cache is rebuilt from it when it was written by another version.
+
+Example
+python bin/convert_docmanager_cache.py external_api_docs/cached_real_docmanager.json external_api_docs/cached_real_docmanager.pkl
+"""
+import sys
+from pathlib import Path
+
+from sage.smartthings.docmanager import DocManager
+
+if __name__ == "__main__":
+    source_path, target_path = Path(sys.argv[1]), Path(sys.argv[2])
+    dm = DocManager.load(source_path)
+    dm.save(target_path)
+    print(f"Converted {source_path} to {target_path}")
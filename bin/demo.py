@@ -15,17 +15,16 @@ curl -d '{"user": "Amal", "command": "is the dishwasher running?"} -X POST http:
 import multiprocessing as mp
 import os
 
-import time
 from dataclasses import dataclass
 
 import langchain
-import requests
 import tyro
 
 from sage.base import BaseConfig
 from sage.base import GlobalConfig
 from sage.coordinators.sage_coordinator import SAGECoordinatorConfig
 from sage.utils.common import check_env_vars
+from sage.utils.trigger_client import wait_for_trigger
 from sage.utils.trigger_server import AllServerRunner
 
 
@@ -103,14 +102,9 @@ if __name__ == "__main__":
 
             return out
 
-        while True:
-            for _, url in demo_config.trigger_servers:
-                trigger = requests.get(url + "/check_triggers").json()
-                print("got trigger from %s" % url, trigger)
+        trigger = wait_for_trigger([url for _, url in demo_config.trigger_servers])
 
-                if trigger:
-                    return trigger["user"], trigger["command"]
-            time.sleep(1)
+        return trigger["user"], trigger["command"]
 
     while True:
         user, command = poll_triggers(demo_config)
@@ -47,6 +47,11 @@ class GlobalConfig:
     "external_api_docs/cached_real_docmanager.json"
 )
 
+    # sqlite file storing the persistent commands (condition code and registered conditions)
+    condition_store_path: Path = Path(os.getenv("SMARTHOME_ROOT")).joinpath(
+        "cache/conditions.db"
+    )
+
 
 @dataclass
 class BaseConfig:
@@ -3,6 +3,8 @@
 import os
 import requests
 import json
+import threading
+from typing import Optional
 
 from sage.retrieval.memory_bank import MemoryBank
 from sage.utils.common import SMARTHOME_ROOT
@@ -56,55 +58,196 @@ def convert_to_natural_language(data: list[dict], source: str) -> list[str]:
         return [json.dumps(d) for d in data]
 
 
+def convert_to_metadata(data: list[dict], source: str) -> list[dict]:
+    """
+    Structured metadata matching the sentences of convert_to_natural_language, used to
+    filter the vector search (e.g. on spaceId). Values are strings, as required by chroma.
+    """
+    if source == "device":
+        return [
+            {
+                "spaceId": str(d.get("spaceId", "N/A")),
+                "deviceId": str(d.get("deviceId", "N/A")),
+                "functionIds": ",".join(
+                    str(f.get("functionId", "N/A")) for f in d.get("functions", [])
+                ),
+            }
+            for d in data
+        ]
+    elif source == "env":
+        return [
+            {
+                "spaceId": str(d.get("spaceId", "N/A")),
+                "personName": str(d.get("personName", "unknown")),
+            }
+            for d in data
+        ]
+    else:
+        return [{} for _ in data]
+
+
 def ensure_json_file(path: str, data: list[dict], source: str):
     if not data:
         return
     os.makedirs(os.path.dirname(path), exist_ok=True)
     with open(path, "w", encoding="utf-8") as f:
-        for line in convert_to_natural_language(data, source):
-            f.write(json.dumps({"instruction": line}, ensure_ascii=False) + "\n")
-
-
-def init_shared_memory() -> MemoryBank:
+        for line, metadata in zip(
+            convert_to_natural_language(data, source), convert_to_metadata(data, source)
+        ):
+            f.write(json.dumps({"instruction": line, "metadata": metadata}, ensure_ascii=False) + "\n")
+
+
+def _load_instruction_memory(path: str, vectorstore: str, memory: MemoryBank, attach: bool) -> None:
+    """Load one of the line-delimited device / environment info files and index it."""
+    memory.read_from_json(path)
+    if isinstance(memory.history, list) and memory.history and isinstance(memory.history[0], dict):
+        items = [item for item in memory.history if "instruction" in item]
+        memory.history = [item["instruction"] for item in items]
+        # files written before metadata was added are indexed without it
+        if items and all(item.get("metadata") for item in items):
+            memory.metadatas = [item["metadata"] for item in items]
+        else:
+            memory.metadatas = None
+    memory.create_indexes(
+        vectorstore, "sentence-transformers/all-MiniLM-L6-v2", sync=not attach, read_only=attach
+    )
+
+
+def build_shared_memory(
+    memories: Optional[dict[str, MemoryBank]] = None, attach: bool = False, refetch: bool = False
+) -> dict[str, MemoryBank]:
+    """
+    Build (or rebuild in place) the user profile, device info and environment info memories.
+
+    Args:
+        memories: existing memories to update in place, so tools holding them see the new data.
+        attach: only open the collections persisted by another process, without fetching from
+            the device API or writing anything. Raises FileNotFoundError if one is missing.
+        refetch: fetch device and environment info from the API even if they are cached on disk.
+    """
     memory_data_root = os.path.join(SMARTHOME_ROOT, "memory_data")
-    os.makedirs(memory_data_root, exist_ok=True)
+
+    if not attach:
+        os.makedirs(memory_data_root, exist_ok=True)
+    memories = memories or {
+        "user_profile": MemoryBank(),
+        "device_info": MemoryBank(),
+        "environment_info": MemoryBank(),
+    }
 
     # ===== 1. 加载用户偏好 memory_bank.json =====
-    memory = MemoryBank()
+    memory = memories["user_profile"]
     user_profile_path = os.path.join(memory_data_root, "memory_bank.json")
     if os.path.exists(user_profile_path):
         memory.read_from_json(user_profile_path)
         if isinstance(memory.history, dict):
-            memory.create_indexes("chroma_userprofile", "sentence-transformers/all-MiniLM-L6-v2", load=False)
+            memory.create_indexes(
+                "chroma_userprofile",
+                "sentence-transformers/all-MiniLM-L6-v2",
+                sync=not attach,
+                read_only=attach,
+            )
         else:
             print("[Warning] memory_bank.json format invalid. Skipped.")
 
     # ===== 2. 单独加载设备信息 device_info.json =====
     device_info_path = os.path.join(memory_data_root, "device_info.json")
-    if not os.path.exists(device_info_path) or os.stat(device_info_path).st_size == 0:
+    if not attach and (
+        refetch or not os.path.exists(device_info_path) or os.stat(device_info_path).st_size == 0
+    ):
         device_info_data = fetch_device_info_from_api()
         ensure_json_file(device_info_path, device_info_data, source="device")
 
-    device_memory = MemoryBank()
-    device_memory.read_from_json(device_info_path)
-    if isinstance(device_memory.history, list) and isinstance(device_memory.history[0], dict):
-        device_memory.history = [item["instruction"] for item in device_memory.history if "instruction" in item]
-    device_memory.create_indexes("chroma_deviceinfo", "sentence-transformers/all-MiniLM-L6-v2", load=False)
+    _load_instruction_memory(device_info_path, "chroma_deviceinfo", memories["device_info"], attach)
 
     # ===== 3. 单独加载环境信息 env_info.json =====
     env_info_path = os.path.join(memory_data_root, "env_info.json")
-    if not os.path.exists(env_info_path) or os.stat(env_info_path).st_size == 0:
+    if not attach and (
+        refetch or not os.path.exists(env_info_path) or os.stat(env_info_path).st_size == 0
+    ):
         env_info_data = fetch_env_info_from_api()
         ensure_json_file(env_info_path, env_info_data, source="env")
 
-    env_memory = MemoryBank()
-    env_memory.read_from_json(env_info_path)
-    if isinstance(env_memory.history, list) and isinstance(env_memory.history[0], dict):
-        env_memory.history = [item["instruction"] for item in env_memory.history if "instruction" in item]
-    env_memory.create_indexes("chroma_environment", "sentence-transformers/all-MiniLM-L6-v2", load=False)
-
-    return {
-        "user_profile": memory,
-        "device_info": device_memory,
-        "environment_info": env_memory
-    }
\ No newline at end of file
+    _load_instruction_memory(env_info_path, "chroma_environment", memories["environment_info"], attach)
+
+    return memories
+
+
+# attach -> memories
+_shared_memory = {}
+_shared_memory_lock = threading.Lock()
+
+
+def init_shared_memory(attach: bool = False) -> dict[str, MemoryBank]:
+    """
+    Get the process-wide memories, building them the first time this is called.
+
+    A process that only needs the collections already persisted by another process
+    (e.g. the listener or the trigger server next to a running coordinator) should use attach=True.
+    Attached and built memories are cached separately.
+    """
+    with _shared_memory_lock:
+        if attach not in _shared_memory:
+            _shared_memory[attach] = build_shared_memory(attach=attach)
+
+        return _shared_memory[attach]
+
+
+def update_environment_info(
+    entries: list[dict], memory: Optional[MemoryBank] = None
+) -> MemoryBank:
+    """
+    Write location updates to the environment info file, replacing the previous location of each
+    person, and sync the environment collection and its manifest with the file.
+
+    Attached memories are read-only: this is how a process other than the coordinator (e.g. the
+    location listener) updates the environment info.
+
+    Args:
+        entries: {"personName", "spaceId", ...} dicts, as returned by the person API
+        memory: environment info memory to update, defaults to the process-wide one (or a new
+            one if it is not built)
+    """
+    env_info_path = os.path.join(SMARTHOME_ROOT, "memory_data", "env_info.json")
+    updated = {
+        metadata["personName"]: {"instruction": line, "metadata": metadata}
+        for line, metadata in zip(
+            convert_to_natural_language(entries, "env"), convert_to_metadata(entries, "env")
+        )
+    }
+
+    with _shared_memory_lock:
+        lines = []
+        if os.path.exists(env_info_path):
+            with open(env_info_path, "r", encoding="utf-8") as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+        lines = [
+            line for line in lines if line.get("metadata", {}).get("personName") not in updated
+        ]
+        lines.extend(updated.values())
+
+        os.makedirs(os.path.dirname(env_info_path), exist_ok=True)
+        # replaced at once, other processes may be reading it
+        with open(env_info_path + ".tmp", "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        os.replace(env_info_path + ".tmp", env_info_path)
+
+        if memory is None and False in _shared_memory:
+            memory = _shared_memory[False]["environment_info"]
+        elif memory is None:
+            memory = MemoryBank()
+        _load_instruction_memory(env_info_path, "chroma_environment", memory, attach=False)
+
+    return memory
+
+
+def refresh_shared_memory(refetch: bool = True) -> dict[str, MemoryBank]:
+    """
+    Re-read the memory sources (re-fetching device and environment info from the API if refetch
+    is True) and sync the indexes. The memories are updated in place.
+    """
+    with _shared_memory_lock:
+        _shared_memory[False] = build_shared_memory(_shared_memory.get(False), refetch=refetch)
+
+        return _shared_memory[False]
@@ -59,11 +59,16 @@ class DeviceInfoTool(SAGEBaseTool):
         query = attr["query"]
         spaceId = str(attr["spaceId"]).strip().lower().replace("space_", "")  # 支持 space_3 或 3 格式
 
+        # devices indexed with metadata can be pre-filtered on their space before ranking,
+        # otherwise fall back to matching the space in the text of the global top_k
+        space_filter = {"spaceId": spaceId} if self.memory.metadatas else None
+
         try:
             search_results = self.memory.search(
                 query=query,
                 vectorstore=self.config.vectordb,
-                top_k=self.config.top_k
+                top_k=self.config.top_k,
+                filter=space_filter,
             )
         except Exception as e:
             return f"[Error] Failed to retrieve device info: {e}"
@@ -71,11 +76,14 @@ class DeviceInfoTool(SAGEBaseTool):
         if not search_results:
             return f"No devices found for spaceId '{spaceId}'."
 
-        # 过滤掉不是该空间的设备信息（解析 spaceId）
-        filtered = []
-        for item in search_results:
-            if isinstance(item, str) and f"space {spaceId}" in item.lower():
-                filtered.append(item)
+        if space_filter is not None:
+            filtered = search_results
+        else:
+            # 过滤掉不是该空间的设备信息（解析 spaceId）
+            filtered = []
+            for item in search_results:
+                if isinstance(item, str) and f"space {spaceId}" in item.lower():
+                    filtered.append(item)
 
         if not filtered:
             return f"No devices found in space {spaceId}."
@@ -1,23 +1,14 @@
 import json
 from confluent_kafka import Consumer as KafkaConsumer
-from langchain.schema import Document
-from sage.chroma_registry.memory_registry import init_shared_memory
+from sage.chroma_registry.memory_registry import convert_to_natural_language
+from sage.chroma_registry.memory_registry import update_environment_info
 
-# 初始化共享 memory（包含 chroma_environment 向量库）
-memory = init_shared_memory()
 index_name = "chroma_environment"
 
-def human_location_to_nl(entry: dict) -> str:
-    """
-    将位置信息转换为自然语言句子。
-    例如 {"id": 4, "personName": "mmhu", "spaceId": 3} ->
-         "User mmhu is currently located in space 3."
-    """
-    name = entry.get("personName", "Unknown")
-    space_id = entry.get("spaceId", "an unknown space")
-    return f"User {name} is currently located in space {space_id}."
-
 def main():
+    # 环境信息由 update_environment_info 写入 env_info.json 并同步向量库和 manifest，
+    # 共享 memory 以 attach 模式打开时是只读的
+    memory = update_environment_info([])
     consumer = KafkaConsumer(
         "env_update",
         bootstrap_servers=["10.192.48.114:9092"],
@@ -32,10 +23,9 @@ def main():
     for message in consumer:
         data = message.value
         try:
-            sentence = human_location_to_nl(data)
-            doc = Document(page_content=sentence, metadata=data)
-            memory.indexes[index_name].add_documents([doc])
-            print(f"[✓] Added to {index_name}: {sentence}")
+            sentence = convert_to_natural_language([data], "env")[0]
+            update_environment_info([data], memory)
+            print(f"[✓] Updated {index_name}: {sentence}")
         except Exception as e:
             print(f"[✗] Failed to process message: {e}")
 
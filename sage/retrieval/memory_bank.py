@@ -7,7 +7,7 @@ The memory bank consists of the following components:
 import os
 import json
 import glob
-from typing import List
+from typing import List, Optional
 from collections import defaultdict
 from langchain.schema.document import Document
 from sage.retrieval.profiler import UserProfiler
@@ -20,6 +20,8 @@ class MemoryBank:
 
     def __init__(self):
         self.history = defaultdict(dict)
+        # metadata of each document when the history is a list (e.g. spaceId of devices)
+        self.metadatas = None
         self.user_profiler = UserProfiler()
         self.indexes = defaultdict(list)
         self.snapshot_id = 0
@@ -167,12 +169,19 @@ class MemoryBank:
             raise ValueError(f"Unsupported history format in MemoryBank: {type(self.history)}")
 
     def create_indexes(
-            self, vectorstore: str, embedding_model: str, load: bool = True
+            self,
+            vectorstore: str,
+            embedding_model: str,
+            load: bool = True,
+            sync: bool = False,
+            read_only: bool = False,
     ) -> None:
         """
         Create vector indexes.
         - If `self.history` is a dict keyed by user_name → create per-user index.
         - Else → create a shared index named by `vectorstore`.
+        If `sync` is True, persisted indexes are updated with only the documents that changed.
+        If `read_only` is True, persisted indexes are only opened (FileNotFoundError if missing).
         """
         emb_function = load_embedding_model(model_name=embedding_model)
 
@@ -201,7 +210,7 @@ class MemoryBank:
 
                 index_name = f"{vectorstore}_{user_name.lower()}"
                 self.indexes[user_name.lower()] = create_multiuser_vector_indexes(
-                    index_name, user_docs, emb_function, load=load
+                    index_name, user_docs, emb_function, load=load, sync=sync, read_only=read_only
                 )[user_name.lower()]
                 print(f"[✓] Created index for user: {user_name}")
 
@@ -209,24 +218,38 @@ class MemoryBank:
         else:
             documents = self.prepare_for_vector_db()
             self.indexes[vectorstore] = create_multiuser_vector_indexes(
-                vectorstore, documents, emb_function, load=load
+                vectorstore,
+                documents,
+                emb_function,
+                load=load,
+                sync=sync,
+                metadatas=self.metadatas,
+                read_only=read_only,
             )
             print(f"[✓] Created global index: {vectorstore}")
 
-    def search(self, query: str, vectorstore: str = None, user_name: str = None, top_k: int = 5) -> List[str]:
+    def search(
+            self,
+            query: str,
+            vectorstore: str = None,
+            user_name: str = None,
+            top_k: int = 5,
+            filter: Optional[dict] = None,
+    ) -> List[str]:
         """
         Generalized search method:
         - If user_name is provided, search in that user's memory index.
         - If vectorstore is provided, search in the named vectorstore index (for env/device info).
+        - If filter is provided, only documents whose metadata match it are ranked.
         """
         if user_name is not None:
             if user_name not in self.indexes:
                 raise ValueError(f"No index found for user: {user_name}")
-            sources = self.indexes[user_name].similarity_search(query, k=top_k)
+            sources = self.indexes[user_name].similarity_search(query, k=top_k, filter=filter)
         elif vectorstore is not None:
             if vectorstore not in self.indexes:
                 raise ValueError(f"No index found for vectorstore: {vectorstore}")
-            sources = self.indexes[vectorstore].similarity_search(query, k=top_k)
+            sources = self.indexes[vectorstore].similarity_search(query, k=top_k, filter=filter)
         else:
             raise ValueError("Must provide either user_name or vectorstore")
 
@@ -62,7 +62,7 @@ class UserProfileTool(SAGEBaseTool):
         else:
             self.memory = memory
             self.memory.create_indexes(
-                config.vectordb, config.embedding_model, load=False
+                config.vectordb, config.embedding_model, sync=True
             )
 
         if isinstance(config.llm_config, OllamaConfig):
@@ -2,7 +2,9 @@
 Everything related to vectordbs
 """
 import os
-from typing import List, Dict
+import json
+from hashlib import sha256
+from typing import List, Dict, Optional
 from pathlib import Path
 import shutil
 from langchain.vectorstores import Chroma, FAISS
@@ -62,6 +64,90 @@ def build_faiss_db(
     return index
 
 
+def document_fingerprint(text: str, metadata: Optional[dict] = None) -> str:
+    """Content fingerprint of a document, used as its id in the vector db."""
+    content = json.dumps([text, metadata or {}], sort_keys=True, ensure_ascii=False)
+
+    return sha256(content.encode("utf-8")).hexdigest()
+
+
+def embedding_signature(embeddings: Embeddings) -> str:
+    """Identifies the vectors produced by an embedding model: class, model name and version."""
+    # unwrap CachedEmbeddings
+    embeddings = getattr(embeddings, "embeddings", embeddings)
+
+    return "%s:%s:%s" % (
+        type(embeddings).__name__,
+        getattr(embeddings, "model", ""),
+        getattr(embeddings, "vector_version", ""),
+    )
+
+
+def sync_chroma_db(
+    vector_dir: str,
+    texts: List[str],
+    embeddings: Embeddings,
+    metadatas: Optional[List[dict]] = None,
+) -> Chroma:
+    """
+    Bring a persisted chroma database in line with texts, only embedding what changed.
+
+    Each document is stored under its content fingerprint. The fingerprints currently in the
+    collection are kept in a manifest next to the collection directory
+    (<vector_dir>.manifest.json): new or changed documents are upserted and the ones that
+    vanished are deleted. Collections without a manifest, or embedded by another model (see
+    embedding_signature), are rebuilt from scratch.
+    """
+    manifest_path = vector_dir.rstrip("/") + ".manifest.json"
+    metadatas = metadatas or [None] * len(texts)
+    documents = {}
+
+    for text, metadata in zip(texts, metadatas):
+        documents[document_fingerprint(text, metadata)] = (text, metadata)
+
+    known_ids = set()
+    signature = embedding_signature(embeddings)
+
+    if os.path.isdir(vector_dir) and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        if manifest.get("embedding") == signature:
+            known_ids = set(manifest["ids"])
+        else:
+            shutil.rmtree(vector_dir)
+            CONSOLE.log(f"{vector_dir} was embedded by another model, existing db wiped!")
+    elif os.path.isdir(vector_dir):
+        shutil.rmtree(vector_dir)
+        CONSOLE.log(f"No manifest found for {vector_dir}, existing db wiped!")
+
+    db = Chroma(persist_directory=vector_dir, embedding_function=embeddings)
+    new_ids = [doc_id for doc_id in documents if doc_id not in known_ids]
+    stale_ids = sorted(known_ids - documents.keys())
+
+    if stale_ids:
+        db.delete(ids=stale_ids)
+
+    if new_ids:
+        metadata_list = [documents[doc_id][1] for doc_id in new_ids]
+        db.add_texts(
+            texts=[documents[doc_id][0] for doc_id in new_ids],
+            metadatas=metadata_list if any(metadata_list) else None,
+            ids=new_ids,
+        )
+    db.persist()
+    CONSOLE.log(
+        f"Synced vector db in {vector_dir}: {len(new_ids)} added, {len(stale_ids)} deleted, "
+        f"{len(documents) - len(new_ids)} unchanged"
+    )
+
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"embedding": signature, "ids": sorted(documents)}, f)
+
+    return db
+
+
 VECTORDBS = {"chroma": build_chroma_db, "faiss": build_faiss_db}
 
 
@@ -70,8 +156,18 @@ def create_multiuser_vector_indexes(
     documents: Union[Dict[str, List[str]], List[str]],
     embedding_model,
     load: bool = True,
+    sync: bool = False,
+    metadatas: Optional[List[dict]] = None,
+    read_only: bool = False,
 ):
-    """Creates a vector index that offers similarity search"""
+    """
+    Creates a vector index that offers similarity search
+
+    If sync is True, persisted indexes are updated incrementally (see sync_chroma_db)
+    instead of being loaded as-is or rebuilt. metadatas is only used for list documents.
+    If read_only is True, persisted indexes are only opened, and missing ones raise
+    FileNotFoundError instead of being built.
+    """
 
     from langchain.vectorstores import Chroma
     import os
@@ -85,7 +181,12 @@ def create_multiuser_vector_indexes(
                 f"{os.getenv('SMARTHOME_ROOT')}", "user_info", user_name, vectorstore
             )
 
-            if load and os.path.exists(user_index_dir):
+            if read_only and not os.path.exists(user_index_dir):
+                raise FileNotFoundError(f"No vector db in {user_index_dir}")
+
+            if sync:
+                db = sync_chroma_db(user_index_dir, memories, embedding_model)
+            elif load and os.path.exists(user_index_dir):
                 db = Chroma(
                     persist_directory=user_index_dir,
                     embedding_function=embedding_model,
@@ -108,7 +209,12 @@ def create_multiuser_vector_indexes(
             f"{os.getenv('SMARTHOME_ROOT')}", "user_info", vectorstore
         )
 
-        if load and os.path.exists(vectorstore_dir):
+        if read_only and not os.path.exists(vectorstore_dir):
+            raise FileNotFoundError(f"No vector db in {vectorstore_dir}")
+
+        if sync:
+            db = sync_chroma_db(vectorstore_dir, documents, embedding_model, metadatas)
+        elif load and os.path.exists(vectorstore_dir):
             db = Chroma(
                 persist_directory=vectorstore_dir,
                 embedding_function=embedding_model,
@@ -117,6 +223,7 @@ def create_multiuser_vector_indexes(
             db = Chroma.from_texts(
                 texts=documents,
                 embedding=embedding_model,
+                metadatas=metadatas,
                 persist_directory=vectorstore_dir,
             )
             db.persist()
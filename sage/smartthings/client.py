@@ -0,0 +1,108 @@
+"""
+Pooled HTTP client for the SmartThings API.
+
+Drop-in replacement for the requests module in the SmartThings tools (it exposes the same get /
+post / request functions), which keeps connections to api.smartthings.com alive between calls
+instead of paying a new TLS handshake for every request.
+"""
+import random
+import time
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# statuses worth retrying. Only 429 is retried for non-idempotent methods, since a 5xx
+# does not tell us whether the device command was executed or not.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("get", "head", "options")
+
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """Parse the Retry-After header (either a number of seconds or an HTTP date)."""
+    retry_after = response.headers.get("Retry-After")
+
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class SmartThingsClient:
+    """
+    Keep-alive session with a bounded connection pool, default timeouts and retries.
+
+    Retries use exponential backoff with full jitter, unless the server specifies a Retry-After.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeout: float = 10,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 30,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _should_retry(self, method: str, status_code: int) -> bool:
+        if status_code == 429:
+            return True
+
+        return status_code in RETRY_STATUSES and method.lower() in IDEMPOTENT_METHODS
+
+    def _backoff(self, attempt: int, response: requests.Response) -> float:
+        delay = retry_after_seconds(response)
+
+        if delay is None:
+            delay = random.uniform(0, self.backoff_factor * 2**attempt)
+
+        return min(delay, self.max_backoff)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Same as requests.request, with retries on rate limits and server errors."""
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            response = self.session.request(method, url, **kwargs)
+
+            if attempt == self.max_retries or not self._should_retry(
+                method, response.status_code
+            ):
+                return response
+            time.sleep(self._backoff(attempt, response))
+
+        return response
+
+    # mimic requests convenience functions
+    def get(self, url, params=None, **kwargs):
+        return self.request("get", url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request("post", url, data=data, json=json, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def get_smartthings_client(
+    pool_size: int = 10, timeout: float = 10, max_retries: int = 3
+) -> SmartThingsClient:
+    """Get the process-wide client for these settings, so all tools share the same pool."""
+    return SmartThingsClient(pool_size=pool_size, timeout=timeout, max_retries=max_retries)
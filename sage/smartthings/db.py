@@ -10,8 +10,6 @@ import time
 from typing import Optional
 
 import requests
-from pymongo import MongoClient
-from pymongo.errors import CollectionInvalid
 
 from sage.base import BaseConfig
 
@@ -31,6 +29,8 @@ class TvScheduleDb:
     db_name = "tv_schedule"
 
     def __init__(self):
+        from pymongo import MongoClient
+
         self.client = MongoClient(mongo_url)
         self.db = self.client[self.db_name]
 
@@ -40,6 +40,8 @@ class TvScheduleDb:
 
         If it already exists, do nothing.
         """
+        from pymongo.errors import CollectionInvalid
+
         try:
             self.db.create_collection(
                 provider_string,
@@ -110,6 +112,8 @@ class DeviceCapabilityDb:
     """
 
     def __init__(self, db_name: str):
+        from pymongo import MongoClient
+
         self.client = MongoClient(mongo_url)
         self.db = self.client[db_name]
 
@@ -133,6 +137,8 @@ class DeviceCapabilityDb:
 
         If it already exists, do nothing.
         """
+        from pymongo.errors import CollectionInvalid
+
         try:
             self.db.create_collection(
                 "device_capabilities",
@@ -6,19 +6,50 @@ The tool uses a VLM (CLIP) to find the image that has the closest embedding to t
 import os
 from dataclasses import dataclass
 from dataclasses import field
-from typing import Any
+from hashlib import sha256
+from typing import TYPE_CHECKING
+from typing import Optional
 from typing import Type
 
-import nltk
 import numpy as np
-import open_clip as clip
-import torch
-from PIL import Image
 
 from sage.base import BaseToolConfig
 from sage.base import SAGEBaseTool
+from sage.smartthings.id_resolver import DeviceIdResolver
+from sage.utils.common import SMARTHOME_ROOT
 from sage.utils.common import parse_json
 
+# torch, open_clip, nltk and PIL take seconds to import, so they are only imported once the
+# detector is actually used
+if TYPE_CHECKING:
+    import open_clip as clip
+    import torch
+
+CLIP_CACHE_ROOT = os.path.join(SMARTHOME_ROOT, "cache", "clip")
+# resource name -> path looked up by nltk.data.find
+NLTK_RESOURCES = {
+    "averaged_perceptron_tagger": "taggers/averaged_perceptron_tagger",
+    "punkt": "tokenizers/punkt",
+}
+_nltk_ready = False
+
+
+def ensure_nltk_resources() -> None:
+    """Download the NLTK resources used by extract_nouns, unless they are already installed."""
+    global _nltk_ready
+
+    if _nltk_ready:
+        return
+
+    import nltk
+
+    for name, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            nltk.download(name)
+    _nltk_ready = True
+
 
 def is_noun(pos):
     return pos[:2] == "NN"
@@ -26,8 +57,9 @@ def is_noun(pos):
 
 def extract_nouns(text: str) -> str:
     """Filter a string to keep only the nouns"""
-    nltk.download("averaged_perceptron_tagger")
-    nltk.download("punkt")
+    import nltk
+
+    ensure_nltk_resources()
 
     tokenized = nltk.word_tokenize(text)
     nouns = [word for (word, pos) in nltk.pos_tag(tokenized) if is_noun(pos)]
@@ -36,9 +68,11 @@ def extract_nouns(text: str) -> str:
 
 
 def get_image_embeds(
-    image_input: torch.Tensor, model: clip.CLIP, device: str = "cpu"
-) -> torch.Tensor:
+    image_input: "torch.Tensor", model: "clip.CLIP", device: str = "cpu"
+) -> np.ndarray:
     """Get image embeddings"""
+    import torch
+
     image_embeds = []
     batch_size = 100
 
@@ -56,9 +90,12 @@ def get_image_embeds(
 
 
 def get_text_embeds(
-    text: list[str], model: clip.CLIP, device: str = "cpu"
-) -> torch.Tensor:
+    text: list[str], model: "clip.CLIP", device: str = "cpu"
+) -> np.ndarray:
     """Get text embeddings"""
+    import open_clip as clip
+    import torch
+
     text_tokens = clip.tokenize(text).to(device)
     with torch.no_grad():
         text_embeds = model.encode_text(text_tokens).cpu().float()
@@ -74,7 +111,7 @@ def clean_embeds(
     drop_above: float = 0.3,
     drop_below: float = 0,
     renorm_after_drop: bool = True,
-) -> torch.Tensor:
+) -> np.ndarray:
     """
     Clean up embeddings, usually by removing large dimensions.
 
@@ -92,15 +129,36 @@ def clean_embeds(
 
 
 class VlmDeviceDetector:
-    """Use a VLM to find the closest match between a user query (text) and available devices (images)."""
+    """
+    Use a VLM to find the closest match between a user query (text) and available devices (images).
+
+    The image embeddings are persisted in cache_path, keyed by file path and modification time,
+    so only the images added or modified since the last call are encoded.
+    """
+
+    def __init__(self, image_folder: str, cache_path: Optional[str] = None):
+        import open_clip as clip
+        import torch
 
-    def __init__(self, image_folder: str):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.image_folder = image_folder
+        self.model_name = "ViT-B-32"
+        self.pretrained = "laion2b_s34b_b79k"
         self.model, _, self.preprocess = clip.create_model_and_transforms(
-            "ViT-B-32", pretrained="laion2b_s34b_b79k"
+            self.model_name, pretrained=self.pretrained
         )
         self.model = self.model.to(self.device)
+        self.id_resolver = DeviceIdResolver([])
+
+        if cache_path is None:
+            folder_hash = sha256(os.path.abspath(image_folder).encode()).hexdigest()[:16]
+            cache_path = os.path.join(
+                CLIP_CACHE_ROOT, f"{self.model_name}-{self.pretrained}-{folder_hash}.npz"
+            )
+        self.cache_path = cache_path
+        # device name -> (filepath, mtime, cleaned image embedding)
+        self.image_embeds = self.load_image_embeds()
+        ensure_nltk_resources()
 
     def identify_device(self, command: str) -> str:
         """
@@ -108,17 +166,15 @@ class VlmDeviceDetector:
 
         The format of the command string should be the same as that described in the DeviceDisambiguationToolConfig.
         """
+        attr_spec = parse_json(command)
 
-        image_dict = self.get_images()
+        if attr_spec is None:
+            return "Invalid JSON format. The input should be a json string with 2 keys: devices (list of guid strings) and disambiguation_information (str): objects or descriptions of device surroundings."
 
-        attr_spec = parse_json(command)
         attr_spec["disambiguation_information"] = extract_nouns(
             attr_spec["disambiguation_information"]
         )
 
-        if attr_spec is None:
-            return "Invalid JSON format. The input should be a json string with 2 keys: devices (list of guid strings) and disambiguation_information (str): objects or descriptions of device surroundings."
-
         # Some LLMs (e.g., LEMUR) query the device disambiguation tool with only
         # one device ID in the list. Instead of returning an error, just return
         # the ID of the device.
@@ -126,41 +182,88 @@ class VlmDeviceDetector:
         if len(attr_spec["devices"]) == 1:
             return attr_spec["devices"][0]
 
+        self.refresh_image_embeds()
         device_list = sorted(
-            self.select_devices(attr_spec["devices"], list(image_dict.keys()))
+            self.select_devices(attr_spec["devices"], list(self.image_embeds.keys()))
         )
 
         if not device_list:
             return "None of the devices you listed were found. Avoid coming up with fake device IDs and consider checking the API planner first. Correct device ID is a guid string not a generic name (e.g. an incorrect name is device1)?"
 
-        with torch.no_grad():
-            text_embeds = get_text_embeds(
-                attr_spec["disambiguation_information"], self.model, self.device
-            )
-            images = [self.preprocess(image_dict[d]["image"]) for d in device_list]
-            images = torch.stack(images)
-            image_embeds = clean_embeds(
-                get_image_embeds(images, self.model, self.device)
+        text_embeds = get_text_embeds(
+            attr_spec["disambiguation_information"], self.model, self.device
+        )
+        image_embeds = np.stack([self.image_embeds[d][2] for d in device_list])
+
+        return device_list[np.argmax((text_embeds @ image_embeds.T).squeeze())]
+
+    def load_image_embeds(self) -> dict[str, tuple[str, float, np.ndarray]]:
+        """Load the image embeddings persisted by a previous run."""
+        if not os.path.exists(self.cache_path):
+            return {}
+
+        with np.load(self.cache_path) as data:
+            return {
+                str(name): (str(path), float(mtime), embed)
+                for name, path, mtime, embed in zip(
+                    data["names"], data["paths"], data["mtimes"], data["embeds"]
+                )
+            }
+
+    def save_image_embeds(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        names = list(self.image_embeds.keys())
+        tmp_path = self.cache_path + ".tmp"
+
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(names, dtype=str),
+                paths=np.array([self.image_embeds[n][0] for n in names], dtype=str),
+                mtimes=np.array([self.image_embeds[n][1] for n in names], dtype=np.float64),
+                embeds=np.stack([self.image_embeds[n][2] for n in names])
+                if names
+                else np.zeros((0, 0), dtype=np.float32),
             )
+        os.replace(tmp_path, self.cache_path)
+
+    def refresh_image_embeds(self) -> None:
+        """Encode the images added or modified since the last refresh and forget deleted ones."""
+        current = {}
 
-            return device_list[np.argmax((text_embeds @ image_embeds.T).squeeze())]
+        for entry in os.scandir(self.image_folder):
+            if entry.is_file():
+                current[entry.name.split(".")[0]] = (entry.path, entry.stat().st_mtime)
 
-    def get_images(self) -> dict[str, Any]:
-        """Load images from image folder."""
-        image_dict = {}
-        file_list = [
-            os.path.join(self.image_folder, file)
-            for file in os.listdir(self.image_folder)
+        stale = [
+            name
+            for name, key in current.items()
+            if name not in self.image_embeds or self.image_embeds[name][:2] != key
         ]
+        removed = [name for name in self.image_embeds if name not in current]
 
-        for filepath in file_list:
-            name = filepath.split("/")[-1].split(".")[0]
-            image_dict[name] = {}
-            image = Image.open(filepath)
-            image_dict[name]["filepath"] = filepath
-            image_dict[name]["image"] = image
+        if not stale and not removed:
+            return
 
-        return image_dict
+        for name in removed:
+            del self.image_embeds[name]
+
+        if stale:
+            import torch
+            from PIL import Image
+
+            images = []
+
+            for name in stale:
+                with Image.open(current[name][0]) as image:
+                    images.append(self.preprocess(image))
+            embeds = clean_embeds(
+                get_image_embeds(torch.stack(images), self.model, self.device)
+            )
+
+            for name, embed in zip(stale, embeds):
+                self.image_embeds[name] = (*current[name], embed)
+        self.save_image_embeds()
 
     def select_devices(
         self, llm_devices: list[str], real_devices: list[str]
@@ -170,23 +273,11 @@ class VlmDeviceDetector:
 
         Necessary because LLMs sometimes make mistakes copying the IDs.
         """
-        threshold = 0.7
-        out = []
-
-        for llm_str in llm_devices:
-            for real_str in real_devices:
-                count = 0
-
-                for c_llm, c_real in zip(llm_str, real_str):
-                    if c_llm == c_real:
-                        count += 1
-                frac = count / len(real_str)
-                # print(frac)
-
-                if frac > threshold:
-                    out.append(real_str)
+        # the image folder rarely changes, keep the resolver until it does
+        if self.id_resolver.device_ids != real_devices:
+            self.id_resolver = DeviceIdResolver(real_devices)
 
-        return out
+        return self.id_resolver.select(llm_devices, threshold=0.7)
 
 
 @dataclass
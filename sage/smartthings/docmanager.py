@@ -1,13 +1,18 @@
 import json
 import os
+import pickle
+import sys
+import threading
 from collections import OrderedDict
 from pathlib import Path
+from typing import Any
 from typing import Optional
 from typing import Union
 
 import requests
 
 from sage.smartthings.db import DeviceCapabilityDb
+from sage.smartthings.id_resolver import DeviceIdResolver
 
 
 def to_ordered_dict_recur(input: Union[list, dict]) -> OrderedDict:
@@ -40,6 +45,27 @@ def dump_ordered_dict_recur(input: OrderedDict) -> list:
         return input
 
 
+def intern_strings_recur(input: Any) -> Any:
+    """
+    Intern all the strings of a JSON-like object.
+
+    Pickle stores each distinct object once, so interning makes repeated strings (capability ids,
+    component names, attribute names, etc.) be stored and loaded only once.
+    """
+    if isinstance(input, str):
+        return sys.intern(input)
+    elif isinstance(input, OrderedDict):
+        return OrderedDict(
+            (intern_strings_recur(k), intern_strings_recur(v)) for k, v in input.items()
+        )
+    elif isinstance(input, dict):
+        return {intern_strings_recur(k): intern_strings_recur(v) for k, v in input.items()}
+    elif isinstance(input, list):
+        return [intern_strings_recur(v) for v in input]
+
+    return input
+
+
 def load_ordered_dict_recur(input: list) -> OrderedDict:
     """Convert output of dump_ordered_dict_recur to OrderedDict"""
 
@@ -52,6 +78,35 @@ def load_ordered_dict_recur(input: list) -> OrderedDict:
     return input
 
 
+# suffixes of DocManager cache files in the binary format
+BINARY_SUFFIXES = (".pkl", ".pickle")
+# version of the binary format, to bump whenever the fields it stores change
+BINARY_FORMAT_VERSION = 1
+# fields stored in the binary format
+BINARY_FORMAT_FIELDS = (
+    "format_version",
+    "default_devices",
+    "device_names",
+    "device_capabilities",
+    "capability_info_from_devices",
+    "online_info",
+    "capability_db_name",
+)
+
+
+class CacheUnpickler(pickle.Unpickler):
+    """
+    Unpickler only loading the types the binary cache is made of (JSON types and OrderedDict),
+    so that loading a cache file can't run arbitrary code.
+    """
+
+    def find_class(self, module: str, name: str) -> Any:
+        if (module, name) == ("collections", "OrderedDict"):
+            return OrderedDict
+
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a DocManager cache")
+
+
 class DocManager:
     """
     Class to manage all the different sources of device / capability documentation,
@@ -75,9 +130,16 @@ class DocManager:
     """
 
     def __init__(self, capability_db_name: str):
-        self.db = DeviceCapabilityDb(db_name=capability_db_name)
+        self.capability_db_name = capability_db_name
+        self._db = None
 
+    @property
+    def db(self) -> DeviceCapabilityDb:
+        """Handle to the capability DB, only connected when a method actually needs it."""
+        if self._db is None:
+            self._db = DeviceCapabilityDb(db_name=self.capability_db_name)
 
+        return self._db
 
     def init(self):
         with open(
@@ -111,6 +173,36 @@ class DocManager:
             for cap_infos in self.device_capabilities.values()
             for cap_info in cap_infos
         }
+        self.build_indexes()
+
+    def build_indexes(self):
+        """
+        Build the lookup tables used to answer queries in constant time.
+
+        Needs to be called again if online_info or device_capabilities are modified.
+        """
+        # capability id -> online doc (first one wins if there are duplicates)
+        self.online_info_by_id = {}
+        for info in self.online_info:
+            self.online_info_by_id.setdefault(info["id"], info)
+
+        # device id -> set of capability ids
+        self.device_capability_ids = {}
+        # (device id, capability id) -> components having the capability
+        self.capability_components = {}
+        for device_id, cap_infos in self.device_capabilities.items():
+            self.device_capability_ids[device_id] = set()
+            for cap in cap_infos:
+                self.device_capability_ids[device_id].add(cap["capability_id"])
+                self.capability_components.setdefault(
+                    (device_id, cap["capability_id"]), []
+                ).append(cap["component_id"])
+
+        # capability id -> output of capability_docs
+        self.capability_docs_cache = {}
+
+        # fuzzy matching of the (often mangled) device ids written by the LLMs
+        self.id_resolver = DeviceIdResolver(self.default_devices)
 
     def to_json(self, json_cache_path: Path):
         """
@@ -122,7 +214,7 @@ class DocManager:
             "device_capabilities": dump_ordered_dict_recur(self.device_capabilities),
             "capability_info_from_devices": self.capability_info_from_devices,
             "online_info": self.online_info,
-            "capability_db_name": self.db.db.name,
+            "capability_db_name": self.capability_db_name,
         }
         with open(json_cache_path, "w") as f:
             json.dump(obj, f)
@@ -134,13 +226,95 @@ class DocManager:
         """
         with open(json_cache_path, "r") as f:
             obj = json.load(f)
-        dm = DocManager('tmp')
+        dm = DocManager(obj["capability_db_name"])
         dm.default_devices = obj["default_devices"]
         dm.device_names = obj["device_names"]
         dm.device_capabilities = load_ordered_dict_recur(obj["device_capabilities"])
         dm.capability_info_from_devices = obj["capability_info_from_devices"]
         dm.online_info = obj["online_info"]
-        dm.db = DeviceCapabilityDb(db_name=obj["capability_db_name"])
+        dm.build_indexes()
+
+        return dm
+
+    def to_pickle(self, pickle_cache_path: Path):
+        """
+        Save self to disk in the binary format (pickle with interned strings).
+
+        Much faster to load than the JSON format, since the nested OrderedDicts don't
+        need to be rebuilt, and each repeated string is only stored once. Only plain data is
+        pickled, not the DocManager itself.
+        """
+        obj = {
+            "format_version": BINARY_FORMAT_VERSION,
+            "default_devices": self.default_devices,
+            "device_names": self.device_names,
+            "device_capabilities": self.device_capabilities,
+            "capability_info_from_devices": self.capability_info_from_devices,
+            "online_info": self.online_info,
+            "capability_db_name": self.capability_db_name,
+        }
+        with open(pickle_cache_path, "wb") as f:
+            pickle.dump(intern_strings_recur(obj), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_pickle(pickle_cache_path: Path):
+        """
+        Create DocManager from the binary format.
+
+        Raises pickle.UnpicklingError if the file is not a valid cache, and ValueError if it was
+        written by another version of the format.
+        """
+        with open(pickle_cache_path, "rb") as f:
+            obj = CacheUnpickler(f).load()
+
+        if (
+            not isinstance(obj, dict)
+            or obj.get("format_version") != BINARY_FORMAT_VERSION
+            or set(obj) != set(BINARY_FORMAT_FIELDS)
+        ):
+            raise ValueError(f"{pickle_cache_path} was written by another version of DocManager")
+        dm = DocManager(obj["capability_db_name"])
+        dm.default_devices = obj["default_devices"]
+        dm.device_names = obj["device_names"]
+        dm.device_capabilities = obj["device_capabilities"]
+        dm.capability_info_from_devices = obj["capability_info_from_devices"]
+        dm.online_info = obj["online_info"]
+        dm.build_indexes()
+
+        return dm
+
+    def save(self, cache_path: Path):
+        """
+        Save self to disk, in the format given by the suffix of cache_path (.json or .pkl).
+        """
+        if Path(cache_path).suffix in BINARY_SUFFIXES:
+            self.to_pickle(cache_path)
+        else:
+            self.to_json(cache_path)
+
+    @staticmethod
+    def load(cache_path: Path):
+        """
+        Create DocManager from disk, in the format given by the suffix of cache_path (.json or .pkl).
+
+        A binary cache which can't be loaded (written by another version, corrupted) is rebuilt
+        from the JSON cache next to it (same name, .json suffix), if there is one.
+        """
+        cache_path = Path(cache_path)
+
+        if cache_path.suffix not in BINARY_SUFFIXES:
+            return DocManager.from_json(cache_path)
+
+        try:
+            return DocManager.from_pickle(cache_path)
+        except (pickle.UnpicklingError, EOFError, ValueError) as e:
+            json_cache_path = cache_path.with_suffix(".json")
+
+            if not json_cache_path.exists():
+                raise
+            print(f"Rebuilding {cache_path} from {json_cache_path}: {e}")
+        dm = DocManager.from_json(json_cache_path)
+        dm.to_pickle(cache_path)
 
         return dm
 
@@ -168,29 +342,22 @@ class DocManager:
         not be properly updated when you read them.
         """
 
-        return bool(
-            [
-                c
-                for c in self.device_capabilities[device_id]
-                if c["capability_id"] == "refresh"
-            ]
-        )
+        return "refresh" in self.device_capability_ids[device_id]
 
     def find_online_info(self, capability_id: str) -> Union[dict, None]:
         """
         Try to find nice online documentation for a capability.
         """
-        info = [x for x in self.online_info if x["id"] == capability_id]
-
-        if info:
-            return info[0]
-
-        return None
+        return self.online_info_by_id.get(capability_id)
 
     def capability_docs(self, capability_id: str) -> dict:
         """
         Get best docs for a single capability.
+
+        The docs are memoized, so the returned dict should not be modified.
         """
+        if capability_id in self.capability_docs_cache:
+            return self.capability_docs_cache[capability_id]
 
         info = self.find_online_info(capability_id)
         cap = self.capability_info_from_devices[capability_id]
@@ -205,13 +372,15 @@ class DocManager:
             one_liner = capability_id
             remaining_docs = self.build_capability_docstring_without_online_info(cap)
 
-        return {
+        self.capability_docs_cache[capability_id] = {
             "id": capability_id,
             "name": name,
             "one_liner": one_liner,
             "docs": remaining_docs,
         }
 
+        return self.capability_docs_cache[capability_id]
+
     def capability_summary_for_devices(
         self, devices: Optional[list[str]] = None
     ) -> tuple[str, str]:
@@ -260,11 +429,32 @@ class DocManager:
         one_liner = capability_docs["one_liner"]
         details = capability_docs["docs"]
         components = ", ".join(
-            [
-                cap["component_id"]
-                for cap in self.device_capabilities[device_id]
-                if cap["capability_id"] == capability_id
-            ]
+            self.capability_components.get((device_id, capability_id), [])
         )
 
         return f"-Device: {device_name} ({device_id}) \n - The API documentation for the capability {one_liner} \n {details} \n - The components for this capability: \n {components}"
+
+
+# json cache path -> (mtime of the file when it was loaded, DocManager)
+_loaded_docmanagers = {}
+_loaded_docmanagers_lock = threading.Lock()
+
+
+def load_docmanager(json_cache_path: Path) -> DocManager:
+    """
+    Get the DocManager for a cache file (JSON or binary), shared by everything in the process.
+
+    The file is only parsed once, and parsed again if its modification time changes (e.g. after
+    running bin/update_smartthings.py).
+    """
+    json_cache_path = str(json_cache_path)
+    mtime = os.stat(json_cache_path).st_mtime
+
+    with _loaded_docmanagers_lock:
+        loaded = _loaded_docmanagers.get(json_cache_path)
+
+        if loaded is None or loaded[0] != mtime:
+            loaded = (mtime, DocManager.load(json_cache_path))
+            _loaded_docmanagers[json_cache_path] = loaded
+
+        return loaded[1]
@@ -0,0 +1,111 @@
+"""
+Fuzzy matching of device IDs.
+
+LLMs regularly mangle the device IDs (guid strings) they copy, so the tools need to find the known
+ID closest to what the LLM wrote. The known IDs are encoded once into numpy arrays, so that
+comparing a query against all of them is a handful of vectorized operations.
+"""
+from typing import Optional
+
+import numpy as np
+
+
+class DeviceIdResolver:
+    """
+    Precomputed representation of a list of device IDs, supporting two kinds of similarity:
+    - positional: fraction of the characters of the known ID matched at the same position
+    - bigram: Dice coefficient of the character bigrams, robust to inserted / dropped characters
+    """
+
+    def __init__(self, device_ids: list[str]):
+        self.device_ids = list(device_ids)
+        self.lengths = np.array([len(d) for d in self.device_ids], dtype=np.int32)
+        max_len = int(self.lengths.max()) if self.device_ids else 0
+
+        # code points of each ID, padded with -1
+        self.chars = np.full((len(self.device_ids), max_len), -1, dtype=np.int32)
+
+        for i, device_id in enumerate(self.device_ids):
+            self.chars[i, : len(device_id)] = [ord(c) for c in device_id]
+
+        # bigram counts of each ID
+        self.bigram_vocab = {}
+
+        for device_id in self.device_ids:
+            for bigram in self._bigrams(device_id):
+                self.bigram_vocab.setdefault(bigram, len(self.bigram_vocab))
+
+        self.bigram_counts = np.zeros(
+            (len(self.device_ids), len(self.bigram_vocab)), dtype=np.int32
+        )
+
+        for i, device_id in enumerate(self.device_ids):
+            for bigram in self._bigrams(device_id):
+                self.bigram_counts[i, self.bigram_vocab[bigram]] += 1
+        self.n_bigrams = self.bigram_counts.sum(axis=1)
+
+    @staticmethod
+    def _bigrams(text: str) -> list[str]:
+        return [text[i : i + 2] for i in range(len(text) - 1)]
+
+    def positional_similarity(self, queries: list[str]) -> np.ndarray:
+        """
+        Fraction of the characters of each known ID that the queries match at the same position.
+
+        Returns:
+            (n_queries, n_ids) array
+        """
+        query_chars = np.full((len(queries), self.chars.shape[1]), -2, dtype=np.int32)
+
+        for i, query in enumerate(queries):
+            query = query[: self.chars.shape[1]]
+            query_chars[i, : len(query)] = [ord(c) for c in query]
+        matches = (query_chars[:, None, :] == self.chars[None, :, :]).sum(axis=-1)
+
+        return matches / np.maximum(self.lengths, 1)[None, :]
+
+    def bigram_similarity(self, query: str) -> np.ndarray:
+        """
+        Dice coefficient between the bigrams of the query and those of each known ID.
+
+        Returns:
+            (n_ids,) array
+        """
+        query_counts = np.zeros(len(self.bigram_vocab), dtype=np.int32)
+        n_query_bigrams = 0
+
+        for bigram in self._bigrams(query):
+            n_query_bigrams += 1
+
+            if bigram in self.bigram_vocab:
+                query_counts[self.bigram_vocab[bigram]] += 1
+        common = np.minimum(self.bigram_counts, query_counts[None, :]).sum(axis=1)
+
+        return 2 * common / np.maximum(self.n_bigrams + n_query_bigrams, 1)
+
+    def rank(self, query: str, k: int = 5) -> list[tuple[str, float]]:
+        """The k known IDs most similar to query, with their bigram similarity."""
+        sims = self.bigram_similarity(query)
+        best = np.argsort(-sims, kind="stable")[:k]
+
+        return [(self.device_ids[idx], float(sims[idx])) for idx in best]
+
+    def most_similar(self, query: str, threshold: float = 0.5) -> Optional[str]:
+        """The known ID most similar to query, if its similarity is above threshold."""
+        ranked = self.rank(query, k=1)
+
+        if ranked and ranked[0][1] > threshold:
+            return ranked[0][0]
+
+        return None
+
+    def select(self, queries: list[str], threshold: float = 0.7) -> list[str]:
+        """
+        All the known IDs matching any of the queries on more than threshold of their characters
+        (positional similarity). One entry per matching (query, ID) pair, in query order.
+        """
+        if not queries or not self.device_ids:
+            return []
+        _, id_idx = np.nonzero(self.positional_similarity(queries) > threshold)
+
+        return [self.device_ids[idx] for idx in id_idx]
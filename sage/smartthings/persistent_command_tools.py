@@ -24,6 +24,8 @@ from sage.smartthings.smartthings_tool import ApiDocRetrievalToolConfig
 from sage.smartthings.smartthings_tool import SmartThingsPlannerToolConfig
 from sage.testing.fake_requests import replace_requests_with_fake_requests
 from sage.utils.common import parse_json
+from sage.utils.condition_store import ConditionStore
+from sage.utils.condition_store import get_condition_store
 from sage.utils.llm_utils import LLMConfig
 from sage.utils.logging_utils import get_callback_handlers
 from sage.utils.trigger_server import run_code
@@ -37,15 +39,16 @@ class PythonInterpreterToolConfig(BaseToolConfig):
 Use like python_interpreter(<python code string here>). Make sure the last line is the entrypoint to your code."""
 
 
-code_registry = {}
-
-
 class PythonInterpreterTool(SAGEBaseTool):
     test_id: str = None
+    condition_store: ConditionStore = None
 
     def setup(self, config: PythonInterpreterToolConfig) -> None:
         """Setup the tool"""
         self.test_id = config.global_config.test_id
+        self.condition_store = get_condition_store(
+            str(config.global_config.condition_store_path)
+        )
 
     def _run(self, command) -> str:
         # I don't know if GPT always writes code where the last line is the actual
@@ -69,11 +72,10 @@ class PythonInterpreterTool(SAGEBaseTool):
                 .replace("\t", "")
             )
             result = run_code(code_define, code_run)
-            code_registry[fn_name] = {
-                "code_define": code_define,
-                "code_run": code_run,
-                "last_result": result,
-            }
+            self.condition_store.put_code(
+                fn_name,
+                {"code_define": code_define, "code_run": code_run, "last_result": result},
+            )
 
             return result
         except Exception:
@@ -199,14 +201,23 @@ notify_when (bool): [true, false]
 condition_description (str)
 action_description (str): what to do when the condition is met
 user_name (str)
+check_interval (int, optional): how often to check the condition, in seconds. Use a short interval for conditions which need a quick reaction, a long one for slowly changing conditions.
 """
+    # shortest check interval the LLM can ask for, in seconds
+    min_check_interval: float = 1.0
 
 
 class NotifyOnConditionTool(SAGEBaseTool):
     server_url: str = None
+    condition_store: ConditionStore = None
+    min_check_interval: float = 1.0
 
     def setup(self, config: NotifyOnConditionToolConfig):
         self.server_url = config.global_config.condition_server_url
+        self.min_check_interval = config.min_check_interval
+        self.condition_store = get_condition_store(
+            str(config.global_config.condition_store_path)
+        )
 
     def _run(self, command: str) -> str:
 
@@ -215,12 +226,21 @@ class NotifyOnConditionTool(SAGEBaseTool):
             return "Invalid input format. Input to the notify_on_condition_tool should be a json string with 5 keys: function_name (str), notify_when (bool), condition_description (str), action_description (str) and user_name (str)."
 
         fn_name = info["function_name"]
-        if fn_name not in code_registry:
+        code = self.condition_store.get_code(fn_name)
+        if code is None:
             return "Unknown function: " + info["function_name"]
 
+        if info.get("check_interval") is not None:
+            try:
+                check_interval = float(info.pop("check_interval"))
+            except (TypeError, ValueError):
+                return "Invalid check_interval: it should be a number of seconds."
+            # the trigger server checks each condition every "interval" seconds
+            info["interval"] = max(check_interval, self.min_check_interval)
+
         requests.post(
             self.server_url + "/add_condition",
-            json={"code": {fn_name: code_registry[fn_name]}, "condition": info},
+            json={"code": {fn_name: code}, "condition": info},
         )
         # condition_registry.append(info)
         return "You will be notified when the condition occurs."
@@ -4,9 +4,10 @@ An agent for interaction with SmartThings devices.
 Used as a tool SAGE.
 """
 import json
+import traceback
 from dataclasses import dataclass
 from dataclasses import field
-from difflib import SequenceMatcher
+from pathlib import Path
 from typing import Any, Dict
 from typing import List
 from typing import Type
@@ -20,27 +21,77 @@ from langchain.chains.llm import LLMChain
 from langchain.chat_models.base import BaseChatModel
 from langchain.prompts import ChatPromptTemplate
 from langchain.prompts.chat import HumanMessagePromptTemplate
+from langchain.schema.language_model import BaseLanguageModel
 from langchain.schema.messages import SystemMessage
 
 import sage.testing.fake_requests
 from sage.base import BaseConfig
 from sage.base import BaseToolConfig
 from sage.base import SAGEBaseTool
+from sage.smartthings.client import get_smartthings_client
 from sage.smartthings.device_disambiguation import DeviceDisambiguationToolConfig
 from sage.smartthings.docmanager import DocManager
+from sage.smartthings.docmanager import load_docmanager
+from sage.smartthings.id_resolver import DeviceIdResolver
+from sage.smartthings.status_cache import DeviceStatusCache
+from sage.smartthings.status_cache import get_device_status_cache
+from sage.utils.common import load_embedding_model
 from sage.utils.common import parse_json
 from sage.utils.llm_utils import LLMConfig
 from sage.utils.llm_utils import TGIConfig
 from sage.utils.logging_utils import get_callback_handlers
 
 
-def most_similar_id(device, all_devices):
-    sims = [SequenceMatcher(None, device, d).ratio() for d in all_devices]
-    idx = np.argmax(sims)
-    closest_sim = sims[idx]
+@dataclass
+class ApiResult:
+    """Outcome of a single call to the SmartThings API."""
+
+    status_code: int
+    body: Any = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code == 200
+
+
+def call_smartthings_api(
+    requests_module: Any, method: str, url: str, token: str, **kwargs
+) -> ApiResult:
+    """
+    Make exactly one request to the SmartThings API and parse its response.
+
+    requests_module can be the requests module, the pooled client or the fake requests used for testing.
+    """
+    headers = {"Authorization": "Bearer %s" % token}
+    response = getattr(requests_module, method)(url, headers=headers, **kwargs)
+
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+
+    return ApiResult(status_code=response.status_code, body=body)
+
+
+class SmartThingsBaseTool(SAGEBaseTool):
+    """
+    Base for the tools that need the SmartThings documentation.
+
+    The DocManager is shared by all tools of the process, see load_docmanager.
+    """
+
+    docmanager_cache_path: Path = None
+
+    @property
+    def dm(self) -> DocManager:
+        return load_docmanager(self.docmanager_cache_path)
 
-    if closest_sim > 0.5:
-        return all_devices[idx]
+
+def most_similar_id(device: str, resolver: DeviceIdResolver) -> str:
+    closest = resolver.most_similar(device, threshold=0.5)
+
+    if closest is not None:
+        return closest
 
     return "to use the planner to figure out the right ID"
 
@@ -57,22 +108,35 @@ component (str)
 capability (str)
 attribute (str)
 """
+    # settings of the pooled SmartThings HTTP client
+    http_pool_size: int = 10
+    http_timeout: float = 10
+    http_max_retries: int = 3
+    # how long (in seconds) refreshes and status reads of a device are reused. 0 disables caching.
+    status_cache_ttl: float = 2.0
 
 
-class GetAttributeTool(SAGEBaseTool):
+class GetAttributeTool(SmartThingsBaseTool):
     """
     Tool for getting a smartthings attribute.
     """
 
-    dm: DocManager = None
     requests_module: Any = requests
     smartthings_token: str = None
+    status_cache: DeviceStatusCache = None
+    status_cache_ttl: float = 0
 
     def setup(self, config: GetAttributeToolConfig):
         if config.global_config.test_id is not None:
             self.requests_module = sage.testing.fake_requests
+        else:
+            self.requests_module = get_smartthings_client(
+                config.http_pool_size, config.http_timeout, config.http_max_retries
+            )
         self.smartthings_token = config.global_config.smartthings_token
-        self.dm = DocManager.from_json(config.global_config.docmanager_cache_path)
+        self.status_cache = get_device_status_cache(config.global_config.test_id)
+        self.status_cache_ttl = config.status_cache_ttl
+        self.docmanager_cache_path = config.global_config.docmanager_cache_path
 
     def _run(self, text: str):
 
@@ -93,10 +157,9 @@ class GetAttributeTool(SAGEBaseTool):
         if device_id not in self.dm.default_devices:
             return (
                 "The device ID you specified does not exist. Did you mean %s?"
-                % most_similar_id(device_id, self.dm.default_devices)
+                % most_similar_id(device_id, self.dm.id_resolver)
             )
 
-        headers = {"Authorization": "Bearer %s" % self.smartthings_token}
         if self.dm.has_refresh_capability(device_id):
             post_url = f"https://api.smartthings.com/v1/devices/{device_id}/commands"
             body = {
@@ -109,25 +172,39 @@ class GetAttributeTool(SAGEBaseTool):
                     }
                 ]
             }
-            self.requests_module.post(url=post_url, json=body, headers=headers)
+            self.status_cache.refresh(
+                device_id,
+                lambda: call_smartthings_api(
+                    self.requests_module, "post", post_url, self.smartthings_token, json=body
+                ),
+                self.status_cache_ttl,
+            )
 
         get_url = f"https://api.smartthings.com/v1/devices/{device_id}/components/{component}/capabilities/{capability}/status"
-        response = self.requests_module.get(get_url, headers=headers)
-        if response.status_code != 200:
+        result = self.status_cache.get(
+            (device_id, component, capability),
+            lambda: call_smartthings_api(
+                self.requests_module, "get", get_url, self.smartthings_token
+            ),
+            self.status_cache_ttl,
+            cacheable=lambda result: result.ok,
+        )
+        if not result.ok:
             return (
-                json.dumps(response.json())
+                json.dumps(result.body)
                 + ". Check the API documentation using the ApiDocRetrievalTool tool."
             )
 
-        try:
-            response = self.requests_module.get(get_url, headers=headers)
-            resp = response.json()
-            if isinstance(resp, dict) and attr_spec["attribute"] in resp:
-                return resp[attr_spec["attribute"]]
-            return resp
-        except Exception:
+        attribute = attr_spec.get("attribute")
+
+        if result.body is None or not isinstance(attribute, str):
             return "Attribute not available. Check the API documentation using the ApiDocRetrievalTool tool."
 
+        if isinstance(result.body, dict) and attribute in result.body:
+            return result.body[attribute]
+
+        return result.body
+
     def _arun(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -145,22 +222,31 @@ capability (str)
 command (str)
 args (list)
 """
+    # settings of the pooled SmartThings HTTP client
+    http_pool_size: int = 10
+    http_timeout: float = 10
+    http_max_retries: int = 3
 
 
-class ExecuteCommandTool(SAGEBaseTool):
+class ExecuteCommandTool(SmartThingsBaseTool):
     """
     Tool for executing a smartthings command.
     """
 
     requests_module: Any = requests
-    dm: DocManager = None
     smartthings_token: str = None
+    status_cache: DeviceStatusCache = None
 
     def setup(self, config: ExecuteCommandToolConfig):
         if config.global_config.test_id is not None:
             self.requests_module = sage.testing.fake_requests
+        else:
+            self.requests_module = get_smartthings_client(
+                config.http_pool_size, config.http_timeout, config.http_max_retries
+            )
         self.smartthings_token = config.global_config.smartthings_token
-        self.dm = DocManager.from_json(config.global_config.docmanager_cache_path)
+        self.status_cache = get_device_status_cache(config.global_config.test_id)
+        self.docmanager_cache_path = config.global_config.docmanager_cache_path
 
     def _run(self, text: str):
         exec_spec = parse_json(text)
@@ -178,12 +264,10 @@ class ExecuteCommandTool(SAGEBaseTool):
         if device_id not in self.dm.default_devices:
             return (
                 "The device ID you specified does not exist. Did you mean %s?"
-                % most_similar_id(device_id, self.dm.default_devices)
+                % most_similar_id(device_id, self.dm.id_resolver)
             )
 
         post_url = f"https://api.smartthings.com/v1/devices/{device_id}/commands"
-        headers = {"Authorization": "Bearer %s" % self.smartthings_token}
-
         body = {
             "commands": [
                 {
@@ -194,16 +278,18 @@ class ExecuteCommandTool(SAGEBaseTool):
                 }
             ]
         }
-        response = self.requests_module.post(url=post_url, json=body, headers=headers)
-        if response.status_code != 200:
+        result = call_smartthings_api(
+            self.requests_module, "post", post_url, self.smartthings_token, json=body
+        )
+        # the command may have changed the device state, even if it failed
+        self.status_cache.invalidate(device_id)
+        if not result.ok:
             return (
-                json.dumps(response.json())
+                json.dumps(result.body)
                 + ". Check the API documentation for more information using the ApiDocRetrievalTool tool."
             )
 
-        return json.dumps(
-            self.requests_module.post(url=post_url, json=body, headers=headers).json()
-        )
+        return json.dumps(result.body)
 
     def _arun(self, *args, **kwargs):
         raise NotImplementedError
@@ -223,11 +309,9 @@ capability_id (str)
 """
 
 
-class ApiDocRetrievalTool(SAGEBaseTool):
-    dm: DocManager = None
-
+class ApiDocRetrievalTool(SmartThingsBaseTool):
     def setup(self, config: ApiDocRetrievalToolConfig) -> None:
-        self.dm = DocManager.from_json(config.global_config.docmanager_cache_path)
+        self.docmanager_cache_path = config.global_config.docmanager_cache_path
 
     def _run(self, text):
 
@@ -246,17 +330,11 @@ class ApiDocRetrievalTool(SAGEBaseTool):
             if obj["device_id"] not in self.dm.default_devices:
                 device_cap_strings.append(
                     "The device ID you specified does not exist. Did you mean %s?"
-                    % most_similar_id(obj["device_id"], self.dm.default_devices)
+                    % most_similar_id(obj["device_id"], self.dm.id_resolver)
                 )
                 continue
 
-            found_cap = False
-            for device_cap in self.dm.device_capabilities[obj["device_id"]]:
-                if device_cap["capability_id"] == obj["capability_id"]:
-                    found_cap = True
-                    break
-
-            if not found_cap:
+            if obj["capability_id"] not in self.dm.device_capability_ids[obj["device_id"]]:
                 device_cap_strings.append(
                     "The device %s does not have capability %s."
                     % (obj["device_id"], obj["capability_id"])
@@ -346,27 +424,22 @@ class SmartThingsPlannerToolConfig(BaseToolConfig):
     name: str = "api_usage_planner"
     description: str = "Used to generate a plan of api calls to make to execute a command. The input to this tool is the user command in natural language. Always share the original user command to this tool to provide the overall context."
     llm_config: LLMConfig = None
+    # If > 0, only list the devices most similar to the command (by name and capabilities) in the
+    # prompt, instead of every device of the home. Cuts the prompt size a lot in large homes.
+    max_candidate_devices: int = 0
+    embedding_model: str = "nomic-embed-text"
 
 
-class SmartThingsPlannerTool(SAGEBaseTool):
-    chain: LLMChain = None
-    logpath: str = None
+def planner_prompt(
+    one_liners_string: str, device_capability_string: str
+) -> ChatPromptTemplate:
+    """Build the prompt of the planner from the capability summaries of the devices."""
 
-    def setup(self, config: SmartThingsPlannerToolConfig):
-        if isinstance(config.llm_config, TGIConfig):
-            config.llm_config = TGIConfig(stop_sequences=["Human", "<FINISHED>"])
-        llm = config.llm_config.instantiate()
-        self.logpath = config.global_config.logpath
-        dm = DocManager.from_json(config.global_config.docmanager_cache_path)
-        (
-            one_liners_string,
-            device_capability_string,
-        ) = dm.capability_summary_for_devices()
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                # - Restate the query 3 different ways
-                SystemMessage(
-                    content=f"""
+    return ChatPromptTemplate.from_messages(
+        [
+            # - Restate the query 3 different ways
+            SystemMessage(
+                content=f"""
 You are a planner that helps users interact with their smart devices.
 You are given a list of high level summaries of device capabilities ("all capabilities:").
 You are also given a list of available devices ("devices you can use") which will tell you the name and device ID of the device, as well as listing which capabilities the device has.
@@ -392,16 +465,78 @@ Plan: steps to execute the command
 Explanation: Any further explanations and notes
 <FINISHED>
 """
-                ),
-                HumanMessagePromptTemplate.from_template(
-                    "{query}.",
-                    input_variables=["query"],
-                ),
-            ],
-        )
+            ),
+            HumanMessagePromptTemplate.from_template(
+                "{query}.",
+                input_variables=["query"],
+            ),
+        ],
+    )
+
 
+class SmartThingsPlannerTool(SAGEBaseTool):
+    # (DocManager, chain listing all of its devices), built on first use
+    chain: Any = None
+    llm: BaseLanguageModel = None
+    logpath: str = None
+    docmanager_cache_path: Path = None
+    max_candidate_devices: int = 0
+    embedding_model: str = None
+    # (device ids, embeddings of their descriptions), computed on first use
+    device_embeddings: Any = None
+
+    def setup(self, config: SmartThingsPlannerToolConfig):
+        if isinstance(config.llm_config, TGIConfig):
+            config.llm_config = TGIConfig(stop_sequences=["Human", "<FINISHED>"])
+        self.llm = config.llm_config.instantiate()
+        self.logpath = config.global_config.logpath
+        self.docmanager_cache_path = config.global_config.docmanager_cache_path
+        self.max_candidate_devices = config.max_candidate_devices
+        self.embedding_model = config.embedding_model
+
+    def _build_chain(
+        self, one_liners_string: str, device_capability_string: str
+    ) -> LLMChain:
         callbacks = get_callback_handlers(self.logpath)
-        self.chain = LLMChain(llm=llm, prompt=prompt, callbacks=callbacks, verbose=True)
+        prompt = planner_prompt(one_liners_string, device_capability_string)
+
+        return LLMChain(llm=self.llm, prompt=prompt, callbacks=callbacks, verbose=True)
+
+    def full_home_chain(self, dm: DocManager) -> LLMChain:
+        """Chain whose prompt lists every device, rebuilt when the DocManager is reloaded."""
+        if self.chain is None or self.chain[0] is not dm:
+            self.chain = (dm, self._build_chain(*dm.capability_summary_for_devices()))
+
+        return self.chain[1]
+
+    def candidate_devices(self, command: str) -> list[str]:
+        """
+        Pick the max_candidate_devices devices whose name and capabilities are the most
+        similar to the command.
+        """
+        dm = load_docmanager(self.docmanager_cache_path)
+        emb = load_embedding_model(self.embedding_model)
+
+        if self.device_embeddings is None or self.device_embeddings[0] != dm.default_devices:
+            descriptions = [
+                "%s: %s"
+                % (
+                    dm.device_names[device_id],
+                    ", ".join(sorted(dm.device_capability_ids[device_id])),
+                )
+                for device_id in dm.default_devices
+            ]
+            embeds = np.array(emb.embed_documents(descriptions))
+            embeds /= np.linalg.norm(embeds, axis=-1, keepdims=True)
+            self.device_embeddings = (list(dm.default_devices), embeds)
+
+        device_ids, embeds = self.device_embeddings
+        query_embed = np.array(emb.embed_query(command))
+        sims = embeds @ (query_embed / np.linalg.norm(query_embed))
+        best = np.argsort(-sims)[: self.max_candidate_devices]
+
+        # keep the usual device order, so that prompts are consistent across runs
+        return sorted(device_ids[idx] for idx in best)
 
     def _run(self, command) -> str:
         # try:
@@ -409,7 +544,22 @@ Explanation: Any further explanations and notes
         # The LLM fails to give the command in natural language
         #    return "The command should be in natural language and not a json."
         # except json.decoder.JSONDecodeError:
-        return self.chain.run(command)
+        dm = load_docmanager(self.docmanager_cache_path)
+
+        chain = None
+
+        if 0 < self.max_candidate_devices < len(dm.default_devices):
+            try:
+                devices = self.candidate_devices(command)
+                chain = self._build_chain(*dm.capability_summary_for_devices(devices))
+            except Exception:
+                # fall back to the prompt listing the full home
+                traceback.print_exc()
+
+        if chain is None:
+            chain = self.full_home_chain(dm)
+
+        return chain.run(command)
 
 
 @dataclass
@@ -0,0 +1,137 @@
+"""
+Device state snapshots shared by the conditions checked in the same poll tick.
+
+The code written by the condition checker GETs the status of the devices it watches through
+the requests module. When several conditions watch the same device, each of them would make
+its own API call every tick. Instead, the requests module seen by the condition code is
+replaced by a proxy which fetches the full status of each device once per tick and answers
+the device and capability status reads from it.
+"""
+import re
+from types import ModuleType
+from typing import Any
+
+SMARTTHINGS_API = "https://api.smartthings.com/v1"
+# device status, or status of a single capability of a component
+STATUS_URL_RE = re.compile(
+    r"^https://api\.smartthings\.com/v1/devices/(?P<device_id>[^/?]+)"
+    r"(?:/components/(?P<component>[^/?]+)/capabilities/(?P<capability>[^/?]+))?/status/?$"
+)
+DEVICE_URL_RE = re.compile(r"^https://api\.smartthings\.com/v1/devices/(?P<device_id>[^/?]+)")
+# names of the modules proxied when they are imported by the condition code
+REQUESTS_MODULES = ("requests", "testing.fake_requests", "sage.testing.fake_requests")
+
+
+class SnapshotResponse:
+    """
+    Mimics the requests.Response object, for reads answered from a snapshot.
+    """
+
+    def __init__(self, json_content: Any, status_code: int = 200):
+        self.json_content = json_content
+        self.status_code = status_code
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self) -> Any:
+        return self.json_content
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+class DeviceStateSnapshot:
+    """
+    Statuses of the devices read during the current tick, keyed by device id.
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        # number of status reads made to the API / answered from the snapshot, for monitoring
+        self.fetches = 0
+        self.hits = 0
+
+    def clear(self) -> None:
+        """Start a new tick."""
+        self.statuses.clear()
+
+    def invalidate(self, device_id: str) -> None:
+        self.statuses.pop(device_id, None)
+
+    def device_status(self, requests_module: Any, device_id: str, **kwargs) -> Any:
+        """Full status of a device, fetched at most once per tick if the fetch succeeds."""
+        if device_id in self.statuses:
+            self.hits += 1
+
+            return self.statuses[device_id]
+        self.fetches += 1
+        response = requests_module.get(
+            f"{SMARTTHINGS_API}/devices/{device_id}/status", **kwargs
+        )
+
+        if response.status_code == 200:
+            self.statuses[device_id] = response
+
+        return response
+
+
+class SnapshotRequests:
+    """
+    Stands in for the requests module (or fake_requests) in condition code, serving device
+    status reads from a DeviceStateSnapshot. Everything else goes to the wrapped module.
+    """
+
+    def __init__(self, module: Any, snapshot: DeviceStateSnapshot):
+        self._module = module
+        self._snapshot = snapshot
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._module, name)
+
+    def request(self, method: str, url: str, **kwargs) -> Any:
+        match = STATUS_URL_RE.match(url)
+
+        if method.lower() != "get":
+            device_match = DEVICE_URL_RE.match(url)
+
+            if device_match is not None:
+                # e.g. a command was sent to the device
+                self._snapshot.invalidate(device_match["device_id"])
+
+            return self._module.request(method, url, **kwargs)
+
+        if match is None or kwargs.get("params"):
+            return self._module.request(method, url, **kwargs)
+
+        kwargs.pop("params", None)
+        status = self._snapshot.device_status(self._module, match["device_id"], **kwargs)
+
+        if match["component"] is None or status.status_code != 200:
+            return status
+
+        try:
+            return SnapshotResponse(
+                status.json()["components"][match["component"]][match["capability"]]
+            )
+        except (KeyError, TypeError):
+            # let the API produce the error for an unknown component / capability
+            return self._module.request(method, url, **kwargs)
+
+    # mimic requests convenience functions
+    def get(self, url, params=None, **kwargs):
+        return self.request("get", url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request("post", url, data=data, json=json, **kwargs)
+
+
+def proxy_requests_modules(namespace: dict, snapshot: DeviceStateSnapshot) -> None:
+    """
+    Replace the requests modules imported in a namespace (that of some condition code) with
+    proxies reading from snapshot.
+    """
+    for name, value in list(namespace.items()):
+        if isinstance(value, ModuleType) and value.__name__ in REQUESTS_MODULES:
+            namespace[name] = SnapshotRequests(value, snapshot)
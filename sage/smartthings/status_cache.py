@@ -0,0 +1,124 @@
+"""
+Short-lived cache of device statuses read from the SmartThings API.
+
+Agents often read several attributes of the same device within a second or two. Without a cache,
+each read posts a refresh command and then GETs the status again. Here, refreshes and status
+reads are remembered for a configurable TTL, concurrent reads of the same device are coalesced
+into a single request, and all entries of a device are dropped whenever a command is executed on it.
+"""
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Hashable, Optional
+
+
+class DeviceStatusCache:
+    """
+    TTL cache of status reads, keyed by (device_id, component, capability).
+
+    Each device has a generation, bumped by invalidate: a read or refresh started before an
+    invalidation is not cached, since it may have seen the state from before the command.
+    """
+
+    def __init__(self):
+        # (device_id, component, capability) -> (timestamp, value)
+        self._entries = {}
+        # device_id -> timestamp of the last refresh
+        self._refreshed = {}
+        # device_id -> number of invalidations
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+        self._device_locks = defaultdict(threading.Lock)
+
+    def _device_lock(self, device_id: str) -> threading.Lock:
+        with self._lock:
+            return self._device_locks[device_id]
+
+    def refresh(self, device_id: str, refresh_fn: Callable[[], Any], ttl: float) -> None:
+        """
+        Call refresh_fn unless the device was refreshed less than ttl seconds ago.
+
+        Concurrent callers for the same device wait for the refresh in flight instead of
+        making their own.
+        """
+        with self._device_lock(device_id):
+            with self._lock:
+                refreshed_at = self._refreshed.get(device_id)
+                generation = self._generations[device_id]
+
+            if refreshed_at is not None and time.monotonic() - refreshed_at < ttl:
+                return
+            refresh_fn()
+
+            with self._lock:
+                if self._generations[device_id] == generation:
+                    self._refreshed[device_id] = time.monotonic()
+
+    def get(
+        self,
+        key: tuple[str, str, str],
+        fetch_fn: Callable[[], Any],
+        ttl: float,
+        cacheable: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """
+        Get the status for key, calling fetch_fn if there is no entry younger than ttl.
+
+        Args:
+            key: (device_id, component, capability)
+            fetch_fn: makes the actual request
+            ttl: maximum age of a cached entry, in seconds
+            cacheable: only results for which this returns True are cached (e.g. errors are not)
+        """
+        with self._device_lock(key[0]):
+            with self._lock:
+                entry = self._entries.get(key)
+                generation = self._generations[key[0]]
+
+            if entry is not None and time.monotonic() - entry[0] < ttl:
+                return entry[1]
+            value = fetch_fn()
+
+            with self._lock:
+                if (cacheable is None or cacheable(value)) and self._generations[
+                    key[0]
+                ] == generation:
+                    self._entries[key] = (time.monotonic(), value)
+
+            return value
+
+    def invalidate(self, device_id: str) -> None:
+        """
+        Forget everything about a device, e.g. because a command changed its state. Does not
+        wait for the reads in flight, which won't be cached.
+        """
+        with self._lock:
+            self._generations[device_id] += 1
+            self._refreshed.pop(device_id, None)
+
+            for key in [k for k in self._entries if k[0] == device_id]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            for device_id in self._generations:
+                self._generations[device_id] += 1
+            self._entries.clear()
+            self._refreshed.clear()
+
+
+_status_caches = {}
+_status_caches_lock = threading.Lock()
+
+
+def get_device_status_cache(namespace: Optional[Hashable] = None) -> DeviceStatusCache:
+    """
+    Get the process-wide cache for a namespace, shared by the tools that read and mutate devices.
+
+    Tests use their test id as namespace, so that device states of different tests never mix.
+    """
+    with _status_caches_lock:
+        if namespace not in _status_caches:
+            _status_caches[namespace] = DeviceStatusCache()
+
+        return _status_caches[namespace]
@@ -6,6 +6,7 @@ import datetime
 import os
 from dataclasses import dataclass
 from dataclasses import field
+from functools import lru_cache
 from typing import Type
 
 import numpy as np
@@ -47,7 +48,10 @@ def add_embeddings(schedule):
     return schedule
 
 
-db = TvScheduleDb()
+@lru_cache(maxsize=None)
+def get_tv_schedule_db() -> TvScheduleDb:
+    """Connect to the TV schedule DB on first use."""
+    return TvScheduleDb()
 
 
 @dataclass
@@ -163,7 +167,7 @@ class QueryTvScheduleTool(SAGEBaseTool):
                 provider_string = "montreal-fibe-tv"
             else:
                 return "value of query argument must be montreal-fibe-tv"
-            on_now = db.whats_on(provider_string)
+            on_now = get_tv_schedule_db().whats_on(provider_string)
 
         on_now = self._inject(on_now)
         query_embed = np.array(emb.embed_query(query))[None, :]
@@ -0,0 +1,83 @@
+"""
+Benchmark of the fake_requests state backends.
+
+Each test case of the benchmark makes many requests through fake_requests, and each of them
+logs the request, reads the state of the device and writes back the changes. This measures
+the time per GET and per POST with each backend of the test logs and device state.
+
+Usage:
+python sage/testing/benchmark_fake_requests.py --backends memory manager mongo
+"""
+import time
+import uuid
+from dataclasses import dataclass
+from dataclasses import field
+
+import tyro
+
+import sage.testing.fake_requests as fake_requests
+from sage.testing.testing_utils import get_base_device_state
+
+
+@dataclass
+class BenchmarkConfig:
+    backends: list[str] = field(default_factory=lambda: ["memory", "manager", "mongo"])
+    # number of GET and of POST requests per backend
+    n_requests: int = 1000
+
+
+def find_switch(device_state: dict) -> str:
+    for device_id, components in device_state.items():
+        if "switch" in components.get("main", {}):
+            return device_id
+
+    raise ValueError("No device with a switch")
+
+
+def run_backend(backend: str, n_requests: int) -> tuple[float, float]:
+    """Returns the time per GET and per POST request, in seconds."""
+    fake_requests.STATE_BACKEND = backend
+    fake_requests.get_test_logs_db.cache_clear()
+    state_server = fake_requests.start_state_server() if backend == "manager" else None
+
+    try:
+        device_state = get_base_device_state()
+        test_id = str(uuid.uuid4())
+        fake_requests.set_test_id(test_id)
+        db = fake_requests.get_test_logs_db()
+        db.set_device_state(test_id, device_state)
+        device_id = find_switch(device_state)
+        url = f"https://api.smartthings.com/v1/devices/{device_id}"
+
+        start = time.time()
+        for _ in range(n_requests):
+            fake_requests.get(url + "/components/main/capabilities/switch/status")
+        # include the time to write the logs
+        db.flush_logs()
+        get_time = (time.time() - start) / n_requests
+
+        start = time.time()
+        for i in range(n_requests):
+            command = {"component": "main", "capability": "switch", "arguments": []}
+            command["command"] = "on" if i % 2 else "off"
+            fake_requests.post(url + "/commands", json={"commands": [command]})
+        db.flush_logs()
+        post_time = (time.time() - start) / n_requests
+
+        final = db.get_device_state(test_id)[device_id]["main"]["switch"]["switch"]["value"]
+        assert final == ("on" if n_requests % 2 == 0 else "off"), final
+    finally:
+        if state_server is not None:
+            state_server.shutdown()
+
+    return get_time, post_time
+
+
+def main(config: BenchmarkConfig) -> None:
+    for backend in config.backends:
+        get_time, post_time = run_backend(backend, config.n_requests)
+        print(f"{backend:8} get={get_time * 1000:.3f}ms post={post_time * 1000:.3f}ms")
+
+
+if __name__ == "__main__":
+    main(tyro.cli(BenchmarkConfig))
@@ -0,0 +1,86 @@
+"""
+Benchmark of the time it takes to import a module, using python -X importtime.
+
+The CLI and the trigger server subprocess import the coordinator before doing anything, so
+heavy libraries (torch, open_clip, nltk, ...) and DB connections must not be loaded at import.
+This reports the total import time, the slowest imports, and fails if any of the heavy
+libraries was imported.
+
+Usage:
+python sage/testing/benchmark_import_time.py --module sage.coordinators.sage_coordinator
+"""
+import subprocess
+import sys
+from dataclasses import dataclass
+from dataclasses import field
+
+import tyro
+
+
+@dataclass
+class BenchmarkConfig:
+    module: str = "sage.coordinators.sage_coordinator"
+    # number of slowest imports to report
+    top_k: int = 20
+    # top-level packages which should only be imported when the tools using them are used
+    lazy_packages: list[str] = field(
+        default_factory=lambda: ["torch", "open_clip", "nltk", "PIL", "pymongo"]
+    )
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int, int]]:
+    """
+    Parse the output of -X importtime.
+
+    Returns:
+        (module, nesting level, self time in us, cumulative time in us) for each import
+    """
+    out = []
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        level = (len(name) - len(name.lstrip())) // 2
+        out.append((name.strip(), level, int(self_us), int(cumulative_us)))
+
+    return out
+
+
+def run_importtime(code: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True
+    )
+
+
+def main(config: BenchmarkConfig) -> None:
+    result = run_importtime(f"import {config.module}")
+
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    # skip the modules imported by the interpreter at startup
+    n_startup = len(parse_importtime(run_importtime("pass").stderr))
+    imports = parse_importtime(result.stderr)[n_startup:]
+    # -X importtime indents nested imports, the top level ones add up to the total
+    total_us = sum(cumulative for _, level, _, cumulative in imports if level == 0)
+    print(f"Importing {config.module} took {total_us / 1e6:.3f}s ({len(imports)} modules)\n")
+
+    print(f"{'cumulative':>12} {'self':>12}  module")
+    for name, level, self_us, cumulative_us in sorted(imports, key=lambda x: -x[3])[
+        : config.top_k
+    ]:
+        print(f"{cumulative_us / 1e3:10.1f}ms {self_us / 1e3:10.1f}ms  {name}")
+
+    eager = sorted(
+        {name.split(".")[0] for name, _, _, _ in imports}.intersection(config.lazy_packages)
+    )
+
+    if eager:
+        print(f"\nFAIL imported at import time: {', '.join(eager)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(tyro.cli(BenchmarkConfig))
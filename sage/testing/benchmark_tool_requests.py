@@ -0,0 +1,127 @@
+"""
+Regression benchmark counting the outbound SmartThings requests made per tool call.
+
+Every request to the SmartThings API costs latency and rate-limit budget, and repeated POSTs
+execute device commands more than once. This runs the SmartThings tools against a recording
+stand-in for the requests module and fails if a tool call makes more requests than expected.
+
+Usage:
+python sage/testing/benchmark_tool_requests.py
+"""
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import tyro
+
+from sage.base import GlobalConfig
+from sage.smartthings.smartthings_tool import ExecuteCommandToolConfig
+from sage.smartthings.smartthings_tool import GetAttributeToolConfig
+from sage.testing.fake_requests import FakeResponse
+
+
+class RecordingRequests:
+    """
+    Stands in for the requests module. Records every request and answers with canned responses.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def request(self, method: str, url: str, **kwargs) -> FakeResponse:
+        self.calls.append((method, url))
+
+        if method == "get":
+            return FakeResponse({"switch": {"value": "on"}})
+
+        return FakeResponse(["successfully executed command"])
+
+    def get(self, url, params=None, **kwargs):
+        return self.request("get", url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request("post", url, data=data, json=json, **kwargs)
+
+
+@dataclass
+class BenchmarkConfig:
+    docmanager_cache_path: Path = Path(os.getenv("SMARTHOME_ROOT")).joinpath(
+        "external_api_docs/cached_test_docmanager.json"
+    )
+    # number of times each sequence of tool calls is repeated
+    repeats: int = 10
+
+
+def run_case(tools, texts: list[str], repeats: int) -> tuple[float, float]:
+    """
+    Run a sequence of tool calls repeats times, starting from an empty device status cache
+    each time. Returns the number of requests and the time per sequence.
+    """
+    recorder = RecordingRequests()
+    start = time.time()
+
+    for _ in range(repeats):
+        for tool in tools:
+            tool.requests_module = recorder
+            tool.status_cache.clear()
+
+        for tool, text in zip(tools, texts):
+            tool._run(text)
+
+    return len(recorder.calls) / repeats, (time.time() - start) / repeats
+
+
+def main(config: BenchmarkConfig) -> None:
+    global_config = GlobalConfig(
+        test_id="benchmark", docmanager_cache_path=config.docmanager_cache_path
+    )
+    get_attribute = GetAttributeToolConfig(global_config=global_config).instantiate()
+    execute_command = ExecuteCommandToolConfig(global_config=global_config).instantiate()
+    dm = get_attribute.dm
+
+    # (name, tools, inputs, max number of requests per sequence of calls)
+    cases = []
+
+    for device_id in dm.default_devices:
+        capabilities = [c["capability_id"] for c in dm.device_capabilities[device_id]]
+
+        if "switch" not in capabilities:
+            continue
+        refresh = dm.has_refresh_capability(device_id)
+        spec = {"device_id": device_id, "component": "main", "capability": "switch"}
+        read = json.dumps(dict(spec, attribute="switch"))
+        execute = json.dumps(dict(spec, command="on", args=[]))
+        n_read = 2 if refresh else 1
+        cases.append((f"get_attribute (refresh={refresh})", [get_attribute], [read], n_read))
+        cases.append(("execute_command", [execute_command], [execute], 1))
+        # reads within the TTL of the status cache hit the network once
+        cases.append(("get_attribute x3", [get_attribute] * 3, [read] * 3, n_read))
+        # executing a command invalidates the cached status
+        cases.append(
+            (
+                "get, execute, get",
+                [get_attribute, execute_command, get_attribute],
+                [read, execute, read],
+                2 * n_read + 1,
+            )
+        )
+
+    failed = False
+
+    for name, tools, texts, expected in cases:
+        n_requests, runtime = run_case(tools, texts, config.repeats)
+        status = "OK" if n_requests <= expected else "FAIL"
+        failed |= n_requests > expected
+        print(
+            f"{status:4} {name:32} requests={n_requests:.2f} (max {expected}) "
+            f"time={runtime * 1000:.2f}ms"
+        )
+
+    sys.exit(int(failed))
+
+
+if __name__ == "__main__":
+    main(tyro.cli(BenchmarkConfig))
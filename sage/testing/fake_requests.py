@@ -7,14 +7,31 @@ the state of all of the devices, rather than on the real devices themselves. The
 logged in a database so that it may be retrieved and tested for correctness. Each request is also
 logged, but currently these logs are not used in validation logic.
 """
+import atexit
+import importlib
 import os
+import queue
+import threading
+import traceback
+from copy import deepcopy
+from functools import lru_cache
+from multiprocessing.managers import BaseManager
+from typing import Any
+from typing import Optional
 
 import requests
 from typing import Union
-from pymongo import MongoClient
-from pymongo.errors import CollectionInvalid
 
 mongo_url = f"mongodb://{os.getenv('MONGODB_SERVER_URL')}"
+# where the test logs and device state are kept: mongo, memory (single process) or manager
+STATE_BACKEND = os.getenv("FAKE_REQUESTS_BACKEND", "mongo")
+# address of the multiprocessing manager serving the state when STATE_BACKEND is manager
+MANAGER_ADDRESS = os.getenv("FAKE_REQUESTS_MANAGER_ADDRESS", "127.0.0.1:5798")
+MANAGER_AUTHKEY = os.getenv("FAKE_REQUESTS_MANAGER_AUTHKEY", "sage").encode()
+# maximum number of logs written at once by the background log writer
+LOG_BATCH_SIZE = 500
+# the code written by the LLM imports this module as testing.fake_requests
+CANONICAL_MODULE = "sage.testing.fake_requests"
 
 test_id = ["-1"]
 
@@ -38,7 +55,132 @@ def replace_requests_with_fake_requests(code: str, test_id: str) -> str:
     )
 
 
-class TestLogsDb:
+class LogWriter:
+    """
+    Writes test logs in batches from a background thread, so that logging a request does not
+    wait for the DB.
+    """
+
+    def __init__(self, write_batch, batch_size: int = LOG_BATCH_SIZE):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def put(self, doc: dict) -> None:
+        self.queue.put(doc)
+
+    def flush(self) -> None:
+        """Wait until all the logs put so far are written."""
+        self.queue.join()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def apply_updates(device: dict, updates: list[tuple[tuple, Any]]) -> None:
+    """Set the values of fields of a device's components, given by their path."""
+    for path, value in updates:
+        target = device
+
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = value
+
+
+class BaseTestLogsDb:
+    """
+    Store of the test logs and of the state of the devices of each test.
+
+    The device state of a test maps device ids to their components, in the format of the
+    SmartThings device status. Reads return copies, like a DB would.
+    """
+
+    # write the logs from a background thread
+    batch_logs: bool = False
+
+    def __init__(self):
+        self.log_writer = LogWriter(self.add_test_logs) if self.batch_logs else None
+
+    def add_test_log(self, test_id: str, log: dict):
+        """
+        Add a single test log to the db.
+        """
+        if test_id == "-1":
+            raise ValueError("You forgot to set the log id")
+        doc = {"test_id": test_id, "log": log}
+
+        if self.log_writer is None:
+            self.add_test_logs([doc])
+        else:
+            self.log_writer.put(doc)
+
+    def flush_logs(self) -> None:
+        if self.log_writer is not None:
+            self.log_writer.flush()
+
+    def get_test_logs(self, test_id: str) -> list[dict]:
+        """
+        Retrieve all logs for a given test.
+        """
+        if test_id == "-1":
+            raise ValueError("You forgot to set the log id")
+        self.flush_logs()
+
+        return self.read_test_logs(test_id)
+
+    def add_test_logs(self, docs: list[dict]) -> None:
+        raise NotImplementedError
+
+    def read_test_logs(self, test_id: str) -> list[dict]:
+        raise NotImplementedError
+
+    def set_device_state(self, test_id: str, device_state: dict):
+        """
+        Update state of all devices for a single test
+        """
+        raise NotImplementedError
+
+    def get_device_state(self, test_id: str) -> dict:
+        """
+        Get state of all devices for a single test.
+        """
+        raise NotImplementedError
+
+    def get_device(self, test_id: str, device_id: str) -> Optional[dict]:
+        """
+        Get the components of a single device, None if the device does not exist.
+        """
+        raise NotImplementedError
+
+    def update_device(self, test_id: str, device_id: str, updates: list[tuple[tuple, Any]]):
+        """
+        Set fields of a device's components without rewriting the rest of the state.
+
+        Args:
+            updates: (path of the field from the components, e.g. (component, capability,
+                attribute, "value"), new value) pairs
+        """
+        raise NotImplementedError
+
+
+class TestLogsDb(BaseTestLogsDb):
     """
     Store test logs.
 
@@ -49,16 +191,22 @@ class TestLogsDb:
     """
 
     db_name = "test_logs"
+    batch_logs = True
 
     def __init__(self):
+        from pymongo import MongoClient
+
         self.client = MongoClient(mongo_url)
         self.db = self.client[self.db_name]
         self._init_collection()
+        super().__init__()
 
     def _init_collection(self):
         """
         Initialize collection if it does not exist already
         """
+        from pymongo.errors import CollectionInvalid
+
         try:
             self.db.create_collection(
                 "test_logs",
@@ -71,28 +219,13 @@ class TestLogsDb:
         except CollectionInvalid:
             pass
 
-    def add_test_log(self, test_id: str, log: dict):
-        """
-        Add a single test log to the db.
-        """
-        if test_id == "-1":
-            raise ValueError("You forgot to set the log id")
-        doc = {"test_id": test_id, "log": log}
-        self.db["test_logs"].insert_one(doc)
-
-    def get_test_logs(self, test_id: str) -> list[dict]:
-        """
-        Retrieve all logs for a given test.
-        """
-        if test_id == "-1":
-            raise ValueError("You forgot to set the log id")
+    def add_test_logs(self, docs: list[dict]) -> None:
+        self.db["test_logs"].insert_many(docs, ordered=False)
 
+    def read_test_logs(self, test_id: str) -> list[dict]:
         return list(self.db["test_logs"].find({"test_id": test_id}))
 
     def set_device_state(self, test_id: str, device_state: dict):
-        """
-        Update state of all devices for a single test
-        """
         self.db["device_state"].find_one_and_replace(
             {"test_id": test_id},
             {"test_id": test_id, "device_state": device_state},
@@ -100,13 +233,157 @@ class TestLogsDb:
         )
 
     def get_device_state(self, test_id: str) -> dict:
-        """
-        Get state of all devices for a single test.
-        """
         return self.db["device_state"].find_one({"test_id": test_id})["device_state"]
 
+    def get_device(self, test_id: str, device_id: str) -> Optional[dict]:
+        doc = self.db["device_state"].find_one(
+            {"test_id": test_id}, {f"device_state.{device_id}": 1}
+        )
+
+        return doc["device_state"].get(device_id)
+
+    def update_device(self, test_id: str, device_id: str, updates: list[tuple[tuple, Any]]):
+        if any("." in key or key.startswith("$") for path, _ in updates for key in path):
+            # some capability names contain dots, which can't be $set by path
+            device = self.get_device(test_id, device_id)
+            apply_updates(device, updates)
+            fields = {f"device_state.{device_id}": device}
+        else:
+            fields = {
+                ".".join(("device_state", device_id) + tuple(path)): value
+                for path, value in updates
+            }
+        self.db["device_state"].update_one({"test_id": test_id}, {"$set": fields})
+
+
+class InMemoryTestLogsDb(BaseTestLogsDb):
+    """
+    Keeps the test logs and device state in the memory of the process. Only usable when the
+    device state is not accessed from several processes, unless served by a StateManager.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.logs = {}
+        self.device_states = {}
+        super().__init__()
+
+    def add_test_logs(self, docs: list[dict]) -> None:
+        with self.lock:
+            for doc in docs:
+                self.logs.setdefault(doc["test_id"], []).append(doc)
+
+    def read_test_logs(self, test_id: str) -> list[dict]:
+        with self.lock:
+            return deepcopy(self.logs.get(test_id, []))
+
+    def set_device_state(self, test_id: str, device_state: dict):
+        with self.lock:
+            self.device_states[test_id] = deepcopy(device_state)
+
+    def get_device_state(self, test_id: str) -> dict:
+        with self.lock:
+            return deepcopy(self.device_states[test_id])
+
+    def get_device(self, test_id: str, device_id: str) -> Optional[dict]:
+        with self.lock:
+            return deepcopy(self.device_states[test_id].get(device_id))
+
+    def update_device(self, test_id: str, device_id: str, updates: list[tuple[tuple, Any]]):
+        with self.lock:
+            apply_updates(self.device_states[test_id][device_id], deepcopy(updates))
 
-db = TestLogsDb()
+
+@lru_cache(maxsize=None)
+def get_shared_state() -> InMemoryTestLogsDb:
+    """State served by the StateManager, called in the manager process."""
+    return InMemoryTestLogsDb()
+
+
+class StateManager(BaseManager):
+    """
+    Serves an InMemoryTestLogsDb to all the processes of a test run (test runner, trigger server
+    and condition workers), as a faster replacement for Mongo.
+    """
+
+
+StateManager.register("get_state", callable=get_shared_state)
+
+
+def manager_address() -> tuple[str, int]:
+    host, port = MANAGER_ADDRESS.rsplit(":", 1)
+
+    return host, int(port)
+
+
+def start_state_server() -> StateManager:
+    """Start the StateManager process, which has to outlive the test runs using it."""
+    manager = StateManager(address=manager_address(), authkey=MANAGER_AUTHKEY)
+    manager.start()
+
+    return manager
+
+
+class ManagerTestLogsDb(BaseTestLogsDb):
+    """
+    Client of the state served by a StateManager (see start_state_server).
+    """
+
+    batch_logs = True
+
+    def __init__(self):
+        manager = StateManager(address=manager_address(), authkey=MANAGER_AUTHKEY)
+        manager.connect()
+        self.state = manager.get_state()
+        super().__init__()
+
+    def add_test_logs(self, docs: list[dict]) -> None:
+        self.state.add_test_logs(docs)
+
+    def read_test_logs(self, test_id: str) -> list[dict]:
+        return self.state.read_test_logs(test_id)
+
+    def set_device_state(self, test_id: str, device_state: dict):
+        self.state.set_device_state(test_id, device_state)
+
+    def get_device_state(self, test_id: str) -> dict:
+        return self.state.get_device_state(test_id)
+
+    def get_device(self, test_id: str, device_id: str) -> Optional[dict]:
+        return self.state.get_device(test_id, device_id)
+
+    def update_device(self, test_id: str, device_id: str, updates: list[tuple[tuple, Any]]):
+        self.state.update_device(test_id, device_id, updates)
+
+
+@lru_cache(maxsize=None)
+def get_test_logs_db() -> BaseTestLogsDb:
+    """
+    Connect to the test logs DB selected by $FAKE_REQUESTS_BACKEND on first use, and share
+    the connection within the process.
+    """
+    if STATE_BACKEND == "mongo":
+        return TestLogsDb()
+
+    if STATE_BACKEND == "manager":
+        return ManagerTestLogsDb()
+
+    if STATE_BACKEND == "memory":
+        if __name__ != CANONICAL_MODULE:
+            # share the state with the other copy of this module in the process
+            return importlib.import_module(CANONICAL_MODULE).get_test_logs_db()
+
+        return InMemoryTestLogsDb()
+
+    raise ValueError("Unknown fake requests backend: %s" % STATE_BACKEND)
+
+
+def __getattr__(name: str):
+    # keeps `from sage.testing.fake_requests import db` working without connecting at import
+    if name == "db":
+        return get_test_logs_db()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class FakeResponse:
@@ -130,48 +407,57 @@ def request(method: str, url: str, **kwargs) -> Union[FakeResponse, requests.Res
     it is written into the database. If the request is not to the smartthings API, use the real
     requests module to complete it.
     """
+    db = get_test_logs_db()
     db.add_test_log(test_id[0], {"method": method, "url": url, "kwargs": kwargs})
     # only intercept requrests to smartthings API, let all others through
 
     if "api.smartthings.com" not in url:
         return requests.request(method, url, **kwargs)
-    device_state = db.get_device_state(test_id[0])
+    url_bits = url.split("/")
+    device_id = url_bits[5]  # might be brittle
+    # only the state of the requested device is read, and only the fields changed are written
+    device = db.get_device(test_id[0], device_id)
 
     if method == "get":
-        url_bits = url.split("/")
+        if device is None:
+            return FakeResponse(["no such device"])
+
         # you can get the status of the entire device instead of a specific component
         # and the code written by the LLM does that, so we need to support it as well.
         # The URL is shorter when this is the case.
-        device_id = url_bits[5]
-
         if len(url_bits) < 8:
-            out = {"components": device_state[device_id]}
+            out = {"components": device}
 
             return FakeResponse(out)
 
         component = url_bits[7]
         capability = url_bits[9]
 
-        if device_id not in device_state:
-            return FakeResponse(["no such device"])
-
-        if component not in device_state[device_id]:
+        if component not in device:
             return FakeResponse(["no such component"])
 
-        if capability not in device_state[device_id][component]:
+        if capability not in device[component]:
             return FakeResponse(["no such capability"])
 
         try:
-            out = device_state[device_id][component][capability]
+            out = device[component][capability]
         except Exception as e:
             out = str(e)
 
         return FakeResponse(out)
 
     elif method == "post":
-        device_id = url.split("/")[5]  # might be brittle
-        update_state = False
+        # (path of the field in the device components, new value) of the changes made
+        updates = []
+
+        def set_value(component: str, capability: str, attribute: str, value: Any) -> None:
+            device[component][capability][attribute]["value"] = value
+            updates.append(((component, capability, attribute, "value"), value))
+
         try:
+            if device is None:
+                raise ValueError(f"The device {device_id} does not exist.")
+
             for com in kwargs["json"]["commands"]:
                 component, capability, command, args = (
                     com["component"],
@@ -181,64 +467,45 @@ def request(method: str, url: str, **kwargs) -> Union[FakeResponse, requests.Res
                 )
                 # turn on/off
 
-                if component not in device_state[device_id].keys():
+                if component not in device.keys():
                     raise ValueError(f"The component {component} is not supported.")
 
                 if capability == "switch":
                     if command in ("on", "off"):
-                        device_state[device_id][component][capability]["switch"][
-                            "value"
-                        ] = command
-                        update_state = True
+                        set_value(component, capability, "switch", command)
                     else:
                         raise ValueError("Invalid command: %s" % command)
                 # change brightness
                 elif capability == "switchLevel":
                     if command == "setLevel":
                         if isinstance(args[0], int):
-                            device_state[device_id][component][capability]["level"][
-                                "value"
-                            ] = args[0]
+                            set_value(component, capability, "level", args[0])
                         else:
                             raise ValueError(
                                 "The switchLevel command expects an integer for the level argument."
                             )
 
-                    update_state = True
-
                 elif capability == "colorTemperature":
                     if command == "setColorTemperature":
-                        device_state[device_id][component][capability][
-                            "colorTemperature"
-                        ]["value"] = args[0]
+                        set_value(component, capability, "colorTemperature", args[0])
 
-                    update_state = True
                 elif capability == "colorControl":
                     if command == "setHue":
                         if args[0] <= 100:
-                            device_state[device_id][component][capability]["hue"][
-                                "value"
-                            ] = args[0]
-                            update_state = True
+                            set_value(component, capability, "hue", args[0])
                         else:
                             raise ValueError(
                                 ["The hue value should be in percentage between 0-100"]
                             )
                     elif command == "setSaturation":
-                        device_state[device_id][component][capability]["saturation"][
-                            "value"
-                        ] = args[0]
-                        update_state = True
+                        set_value(component, capability, "saturation", args[0])
 
                     elif command == "setColor":
                         if args[0]["hue"] <= 100:
-                            device_state[device_id][component][capability]["hue"][
-                                "value"
-                            ] = args[0]["hue"]
-                            device_state[device_id][component][capability][
-                                "saturation"
-                            ]["value"] = args[0]["saturation"]
-                            update_state = True
+                            set_value(component, capability, "hue", args[0]["hue"])
+                            set_value(
+                                component, capability, "saturation", args[0]["saturation"]
+                            )
                         else:
                             raise ValueError(
                                 ["The hue value should be in percentage between 0-100"]
@@ -247,30 +514,20 @@ def request(method: str, url: str, **kwargs) -> Union[FakeResponse, requests.Res
                 elif capability == "tvChannel":
                     if command == "setTvChannel":
                         # TODO check if the arguments is the right type
-                        device_state[device_id][component][capability]["tvChannel"][
-                            "value"
-                        ] = args[0]
-                        update_state = True
+                        set_value(component, capability, "tvChannel", args[0])
                     else:
                         raise ValueError("Invalid command or value: %s" % command)
 
                 # change TV audio
                 elif capability == "audioVolume":
+                    volume = device[component][capability]["volume"]
+
                     if command == "setVolume":
-                        device_state[device_id][component][capability]["volume"][
-                            "value"
-                        ] = args[0]
-                        update_state = True
+                        set_value(component, capability, "volume", args[0])
                     elif command == "volumeDown":
-                        device_state[device_id][component][capability]["volume"][
-                            "value"
-                        ] -= 5
-                        update_state = True
+                        set_value(component, capability, "volume", volume["value"] - 5)
                     elif command == "volumeUp":
-                        device_state[device_id][component][capability]["volume"][
-                            "value"
-                        ] += 5
-                        update_state = True
+                        set_value(component, capability, "volume", volume["value"] + 5)
                     else:
                         raise ValueError(
                             f"Invalid command: {command} for the capability {capability}"
@@ -281,33 +538,23 @@ def request(method: str, url: str, **kwargs) -> Union[FakeResponse, requests.Res
                         pass
                 elif capability == "samsungce.dishwasherWashingCourse":
                     if command == "setWashingCourse":
-                        device_state[device_id][component][
-                            "samsungce.dishwasherWashingCourse"
-                        ]["washingCourse"]["value"] = args[0]
-                        update_state = True
+                        set_value(component, capability, "washingCourse", args[0])
 
                 elif capability == "execute":
                     if command == "start":
-                        device_state[device_id][component]["dishwasherOperatingState"][
-                            "machineState"
-                        ]["value"] = "run"
-                        update_state = True
+                        set_value(
+                            component, "dishwasherOperatingState", "machineState", "run"
+                        )
                     else:
                         raise ValueError("Invalid command or value: %s" % command)
                 elif capability == "custom.thermostatSetpointControl":
                     if command == "setSetpoint":
-                        device_state[device_id][component]["temperatureMeasurement"][
-                            "temperature"
-                        ]["value"] = args[0]
-                        update_state = True
+                        set_value(component, "temperatureMeasurement", "temperature", args[0])
                     else:
                         raise ValueError("Invalid command or value: %s" % command)
                 elif capability == "dishwasherOperatingState":
                     if command == "setMachineState":
-                        device_state[device_id][component]["dishwasherOperatingState"][
-                            "machineState"
-                        ]["value"] = args[0]
-                        update_state = True
+                        set_value(component, capability, "machineState", args[0])
                     else:
                         raise ValueError("Invalid command: %s" % command)
 
@@ -318,13 +565,8 @@ def request(method: str, url: str, **kwargs) -> Union[FakeResponse, requests.Res
                         )
 
                     if command == "setCoolingSetpoint":
-                        device_state[device_id][component]["thermostatCoolingSetpoint"][
-                            "coolingSetpoint"
-                        ]["value"] = args[0]
-                        device_state[device_id][component]["temperatureMeasurement"][
-                            "temperature"
-                        ]["value"] = args[0]
-                        update_state = True
+                        set_value(component, capability, "coolingSetpoint", args[0])
+                        set_value(component, "temperatureMeasurement", "temperature", args[0])
                 else:
                     return FakeResponse(
                         ["capability not supported yet"], status_code=500
@@ -332,8 +574,8 @@ def request(method: str, url: str, **kwargs) -> Union[FakeResponse, requests.Res
         except Exception as e:
             return FakeResponse(["An error occurred: " + str(e)], status_code=500)
 
-        if update_state:
-            db.set_device_state(test_id[0], device_state)
+        if updates:
+            db.update_device(test_id[0], device_id, updates)
 
         return FakeResponse(["successfully executed command"])
     else:
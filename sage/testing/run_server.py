@@ -1,7 +1,18 @@
+from sage.testing import fake_requests
 from sage.utils.common import CONSOLE
 from sage.utils.trigger_server import AllServerRunner
 
 if __name__ == "__main__":
+    state_server = None
+
+    if fake_requests.STATE_BACKEND == "manager":
+        # the device state of the tests is served to the test runner and the condition workers
+        state_server = fake_requests.start_state_server()
+        CONSOLE.print(f"serving device state on {fake_requests.MANAGER_ADDRESS}")
     server_runner = AllServerRunner()
     server_runner.run()
     CONSOLE.print("ran server!!")
+
+    if state_server is not None:
+        # the state server is shut down when this process exits
+        server_runner.process.join()
@@ -13,6 +13,8 @@ for each test separately in the Mongo DB (testing.fake_requests.db), and state u
 are done by writing the state to this DB. A DB is used to support simultaneous access
 from multiple processes, which is necessary because the state is read not only by the
 agent but also by the code written by the agent, which is executed by the polling server.
+With FAKE_REQUESTS_BACKEND=manager, the state is instead kept in the memory of a process
+started by run_server.py.
 By the way, the need to intercept requests made by the python code written by the LLM
 is what motivated me to create the fake requests module, as opposed to intercepting
 the traffic at a higher level (e.g. in the GetAttribute and ExecuteCommand tools).
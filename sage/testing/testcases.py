@@ -18,7 +18,7 @@ from langchain.utilities import OpenWeatherMapAPIWrapper
 
 from sage.misc_tools.gcloud_auth import gcloud_authenticate
 from sage.misc_tools.google_suite import GoogleCalendarListEventsTool
-from sage.testing.fake_requests import db
+from sage.testing.fake_requests import get_test_logs_db
 from sage.testing.testing_utils import listen
 from sage.testing.testing_utils import manual_gmail_search
 from sage.testing.testing_utils import pretty_print_email
@@ -112,7 +112,7 @@ def turn_on_tv(device_state, config):
     test_id, coordinator = setup(device_state, config.coordinator_config)
     user_command = "Amal: turn on the TV"
     coordinator.execute(user_command)
-    device_state = db.get_device_state(test_id)
+    device_state = get_test_logs_db().get_device_state(test_id)
     assert (
         device_state[tv_id]["main"]["switch"]["switch"]["value"] == "on"
     ), "TV was not turned on"
\ No newline at end of file
@@ -3,7 +3,6 @@ import html
 import inspect
 import os
 import pickle as pkl
-import time
 import uuid
 from functools import lru_cache
 from typing import Any
@@ -17,8 +16,9 @@ from langchain.pydantic_v1 import Field
 from sage.base import BaseConfig
 from sage.coordinators.base import BaseCoordinator
 from sage.coordinators.base import CoordinatorConfig
-from sage.testing.fake_requests import db
+from sage.testing.fake_requests import get_test_logs_db
 from sage.testing.fake_requests import set_test_id
+from sage.utils.trigger_client import wait_for_trigger
 
 
 current_save_dir = [None]
@@ -43,7 +43,7 @@ def setup(
     coordinator = config.instantiate()
 
     # write state to db
-    db.set_device_state(test_id, device_state)
+    get_test_logs_db().set_device_state(test_id, device_state)
 
     # reset condition server
     requests.get(BaseConfig.global_config.condition_server_url + "/reset")
@@ -55,17 +55,12 @@ def setup(
 def listen(demo_config: BaseConfig, timeout: int = 15) -> None:
     """Listen for responses from the trigger server"""
     # timeout in seconds
-    # poll triggers
-    start_time = time.time()
-
-    while (start_time + timeout) >= time.time():
-        for _, url in demo_config.trigger_servers:
-            trigger = requests.get(url + "/check_triggers").json()
-            print("got trigger from %s" % url, trigger)
+    trigger = wait_for_trigger(
+        [url for _, url in demo_config.trigger_servers], timeout=timeout
+    )
 
-            if trigger:
-                return trigger["user"], trigger["command"]
-        time.sleep(1)
+    if trigger:
+        return trigger["user"], trigger["command"]
 
 
 @lru_cache(maxsize=None)
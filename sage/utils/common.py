@@ -16,11 +16,19 @@ from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.output_parsers.json import parse_json_markdown
 from rich.console import Console
 
+from sage.utils.embedding_utils import CachedEmbeddings
+from sage.utils.embedding_utils import EmbeddingStore
 from sage.utils.embedding_utils import OllamaEmbeddingOnly
 
 # ====== 常量定义 ======
 SMARTHOME_ROOT = os.getenv("SMARTHOME_ROOT", "/home/nanachi/SAGE")
 CONSOLE = Console(width=120)
+EMBEDDING_CACHE_ROOT = os.path.join(SMARTHOME_ROOT, "cache", "embeddings")
+# Ollama model serving the embedding models requested by name. The sentence-transformers models
+# have always been served by nomic-embed-text, which Ollama has (it does not have those names)
+OLLAMA_EMBEDDING_MODELS = {
+    "sentence-transformers/all-MiniLM-L6-v2": "nomic-embed-text",
+}
 
 
 # ====== 环境检查 ======
@@ -90,9 +98,15 @@ def function2string(function_handle: Any, code_define: str) -> str:
 
 
 # ====== 嵌入模型加载 ======
+@lru_cache(maxsize=None)
 def load_embedding_model(model_name: str = "nomic-embed-text"):
-    """Builds and caches an embedding model."""
-    return OllamaEmbeddingOnly(model=model_name)
+    """
+    Builds and caches an embedding model. Its embeddings are persisted on disk per name of the
+    model which computes them.
+    """
+    model = OLLAMA_EMBEDDING_MODELS.get(model_name, model_name)
+    store = EmbeddingStore(os.path.join(EMBEDDING_CACHE_ROOT, model.replace("/", "__")))
+    return CachedEmbeddings(OllamaEmbeddingOnly(model=model), store)
 
 
 # ====== 时间线追踪工具 ======
@@ -0,0 +1,264 @@
+"""
+Durable registry of the persistent commands (conditions and the code checking them).
+
+The code written by the condition checker agent is expensive to produce, so it is stored in SQLite
+as soon as it has been run, along with the conditions registered on the trigger server, which are
+reloaded when the server restarts. Code is deduplicated by the hash of its source.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+from hashlib import sha256
+from typing import Any
+from typing import Optional
+
+
+def default_condition_store_path() -> str:
+    """$CONDITION_STORE_PATH, or $SMARTHOME_ROOT/cache/conditions.db"""
+    return os.getenv(
+        "CONDITION_STORE_PATH",
+        os.path.join(os.getenv("SMARTHOME_ROOT", "."), "cache", "conditions.db"),
+    )
+
+
+def _dumps(obj: Any) -> str:
+    # results of the condition code may be numpy scalars
+    return json.dumps(obj, default=lambda o: o.item() if hasattr(o, "item") else str(o))
+
+
+def code_hash(code: dict) -> str:
+    """Hash of the source of some condition code."""
+    return sha256(json.dumps([code["code_define"], code["code_run"]]).encode()).hexdigest()
+
+
+def condition_key(condition: dict, code: dict) -> str:
+    """Conditions with the same key are duplicates of each other."""
+    return sha256(
+        json.dumps([code_hash(code), condition], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class ConditionStore:
+    """
+    SQLite-backed store, with tables:
+    - codes: condition code, keyed by code hash. Rows are never modified
+    - functions: function name -> code hash, the latest row wins
+    - events: append-only log of the code runs and of the add / remove / result / reset of the
+      conditions, never modified
+    - function_results, conditions: snapshots of the event log (last result of each function,
+      conditions registered since the last reset), written in the same transaction as the events
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS codes (
+                code_hash TEXT PRIMARY KEY,
+                code_define TEXT NOT NULL,
+                code_run TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS functions (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                function_name TEXT NOT NULL,
+                code_hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS functions_name ON functions (function_name);
+            CREATE TABLE IF NOT EXISTS function_results (
+                function_name TEXT PRIMARY KEY,
+                last_result TEXT
+            );
+            CREATE TABLE IF NOT EXISTS conditions (
+                condition_id TEXT PRIMARY KEY,
+                condition_key TEXT NOT NULL UNIQUE,
+                condition TEXT NOT NULL,
+                code_hash TEXT NOT NULL,
+                last_result TEXT
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                type TEXT NOT NULL,
+                condition_id TEXT,
+                payload TEXT
+            );
+            """
+        )
+        self._conn.commit()
+
+    def _append_event(
+        self, event_type: str, condition_id: Optional[str], payload: Any
+    ) -> None:
+        self._conn.execute(
+            "INSERT INTO events (ts, type, condition_id, payload) VALUES (?, ?, ?, ?)",
+            (time.time(), event_type, condition_id, _dumps(payload)),
+        )
+
+    def _put_code(self, function_name: str, code: dict) -> str:
+        digest = code_hash(code)
+        self._conn.execute(
+            "INSERT OR IGNORE INTO codes (code_hash, code_define, code_run) VALUES (?, ?, ?)",
+            (digest, code["code_define"], code["code_run"]),
+        )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO function_results VALUES (?, ?)",
+            (function_name, _dumps(code.get("last_result"))),
+        )
+        self._append_event(
+            "code",
+            None,
+            {
+                "function_name": function_name,
+                "code_hash": digest,
+                "last_result": code.get("last_result"),
+            },
+        )
+        latest = self._conn.execute(
+            """
+            SELECT code_hash FROM functions WHERE function_name = ?
+            ORDER BY seq DESC LIMIT 1
+            """,
+            (function_name,),
+        ).fetchone()
+
+        if latest is None or latest[0] != digest:
+            self._conn.execute(
+                "INSERT INTO functions (function_name, code_hash) VALUES (?, ?)",
+                (function_name, digest),
+            )
+
+        return digest
+
+    def put_code(self, function_name: str, code: dict) -> str:
+        """Store the code of a function and the result of its last run, returns its hash."""
+        with self._lock, self._conn:
+            return self._put_code(function_name, code)
+
+    def get_code(self, function_name: str) -> Optional[dict]:
+        """Latest code stored for a function, None if there is none."""
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT code_define, code_run, function_results.last_result FROM functions
+                JOIN codes ON functions.code_hash = codes.code_hash
+                LEFT JOIN function_results
+                    ON functions.function_name = function_results.function_name
+                WHERE functions.function_name = ? ORDER BY seq DESC LIMIT 1
+                """,
+                (function_name,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            "code_define": row[0],
+            "code_run": row[1],
+            "last_result": None if row[2] is None else json.loads(row[2]),
+        }
+
+    def add_condition(self, condition: dict, code: dict) -> tuple[str, bool]:
+        """
+        Register a condition, unless the same condition is already registered with the same code.
+
+        Returns:
+            the id of the condition, and whether it was newly added
+        """
+        key = condition_key(condition, code)
+        condition_id = uuid.uuid4().hex
+
+        with self._lock, self._conn:
+            # the key is unique: of concurrent adds of the same condition, only one inserts it
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO conditions VALUES (?, ?, ?, ?, ?)",
+                (
+                    condition_id,
+                    key,
+                    _dumps(condition),
+                    code_hash(code),
+                    _dumps(code.get("last_result")),
+                ),
+            ).rowcount
+
+            if not inserted:
+                row = self._conn.execute(
+                    "SELECT condition_id FROM conditions WHERE condition_key = ?", (key,)
+                ).fetchone()
+                return row[0], False
+            digest = self._put_code(condition["function_name"], code)
+            self._append_event(
+                "add",
+                condition_id,
+                {
+                    "condition": condition,
+                    "code_hash": digest,
+                    "last_result": code.get("last_result"),
+                },
+            )
+
+        return condition_id, True
+
+    def remove_condition(self, condition_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM conditions WHERE condition_id = ?", (condition_id,))
+            self._append_event("remove", condition_id, None)
+
+    def record_result(self, condition_id: str, result: Any) -> None:
+        """Remember the last result of a condition, so that restarts don't re-trigger it."""
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                "UPDATE conditions SET last_result = ? WHERE condition_id = ?",
+                (_dumps(result), condition_id),
+            ).rowcount
+
+            if updated:
+                self._append_event("result", condition_id, result)
+
+    def reset(self) -> None:
+        """Remove all the conditions. The events that led to them stay in the log."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM conditions")
+            self._append_event("reset", None, None)
+
+    def load(self) -> dict[str, dict]:
+        """
+        Get the registered conditions.
+
+        Returns:
+            condition id -> {"condition", "code", "last_result"}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT condition_id, condition, code_define, code_run, conditions.last_result
+                FROM conditions JOIN codes ON conditions.code_hash = codes.code_hash
+                ORDER BY conditions.rowid
+                """
+            ).fetchall()
+
+        return {
+            condition_id: {
+                "condition": json.loads(condition),
+                "code": {
+                    "code_define": code_define,
+                    "code_run": code_run,
+                    "last_result": json.loads(last_result),
+                },
+                "last_result": json.loads(last_result),
+            }
+            for condition_id, condition, code_define, code_run, last_result in rows
+        }
+
+
+@lru_cache(maxsize=None)
+def get_condition_store(path: str) -> ConditionStore:
+    """Get the process-wide store for a path."""
+    return ConditionStore(path)
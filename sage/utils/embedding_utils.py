@@ -1,22 +1,222 @@
+import fcntl
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from hashlib import sha256
+from typing import Optional
+
+import numpy as np
 from langchain.embeddings.base import Embeddings
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class OllamaEmbeddingOnly(Embeddings):
-    def __init__(self, model: str = "nomic-embed-text"):
+    """
+    Embeddings served by a local Ollama instance.
+
+    Documents are sent to the batch /api/embed endpoint in chunks of batch_size texts. Chunks
+    are embedded concurrently over a pooled keep-alive session, and failed requests
+    (connection errors, 429 and 5xx) are retried with exponential backoff.
+    """
+
+    # bump when the vectors produced for the same model change (2: normalized /api/embed)
+    vector_version = 2
+
+    def __init__(
+        self,
+        model: str = "nomic-embed-text",
+        base_url: str = "http://localhost:11434",
+        batch_size: int = 64,
+        max_workers: int = 4,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: float = 60,
+    ):
         self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def embed_documents(self, texts):
-        return [self._embed(text) for text in texts]
+        batches = [
+            texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+
+        if len(batches) <= 1:
+            return [emb for batch in batches for emb in self._embed_batch(batch)]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(self._embed_batch, batches)
+
+            return [emb for batch in results for emb in batch]
 
     def embed_query(self, text):
-        return self._embed(text)
+        return self._embed_batch([text])[0]
 
-    def _embed(self, text: str):
-        response = requests.post("http://localhost:11434/api/embeddings", json={
-            "model": "nomic-embed-text",
-            "prompt": text
-        })
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        response = self.session.post(
+            f"{self.base_url}/api/embed",
+            json={"model": self.model, "input": texts},
+            timeout=self.timeout,
+        )
         response.raise_for_status()
-        return response.json()["embedding"]
\ No newline at end of file
+        return response.json()["embeddings"]
+
+
+class EmbeddingStore:
+    """
+    Persistent text hash -> vector store.
+
+    Vectors are kept in a raw float32 matrix (vectors.f32) that is read through a memory map,
+    and index.txt lists the hash of the text stored in each row of the matrix. Both files are
+    only ever appended to, under a file lock, so several processes can share the same store.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.index_path = os.path.join(directory, "index.txt")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.lock_path = os.path.join(directory, ".lock")
+
+        self.rows = {}
+        self.n_rows = 0
+        self.dim = None
+        self._index_offset = 0
+        self._matrix = None
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def _refresh(self) -> None:
+        """Pick up rows appended since the last refresh (possibly by another process)."""
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path) as f:
+            f.seek(self._index_offset)
+
+            for line in f:
+                if not line.endswith("\n"):
+                    # partially written line, will be picked up on the next refresh
+                    break
+                self.rows.setdefault(line.strip(), self.n_rows)
+                self.n_rows += 1
+                self._index_offset += len(line)
+
+    def _vectors(self) -> np.ndarray:
+        """Memory map of the vectors, remapped whenever rows were added."""
+        if self._matrix is None or self._matrix.shape[0] < self.n_rows:
+            self._matrix = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r", shape=(self.n_rows, self.dim)
+            )
+
+        return self._matrix
+
+    def get(self, keys: list[str]) -> list[Optional[np.ndarray]]:
+        """Get the vectors stored for keys, None for the keys that are not in the store."""
+        with self._lock:
+            if any(key not in self.rows for key in keys):
+                self._refresh()
+
+            if not self.rows:
+                return [None] * len(keys)
+            matrix = self._vectors()
+
+            return [
+                np.array(matrix[self.rows[key]]) if key in self.rows else None
+                for key in keys
+            ]
+
+    def put(self, keys: list[str], vectors: list[list[float]]) -> None:
+        """Append new vectors to the store."""
+        if not keys:
+            return
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w") as f:
+                    json.dump({"dim": self.dim}, f)
+
+            new = [(k, v) for k, v in zip(keys, vectors) if k not in self.rows]
+            new = list(dict(new).items())
+
+            if not new:
+                return
+
+            # write at the offset matching the index, so rows of an interrupted write get overwritten
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(self.n_rows * self.dim * 4)
+                f.write(np.stack([v for _, v in new]).tobytes())
+            with open(self.index_path, "a") as f:
+                f.write("".join(k + "\n" for k, _ in new))
+            self._refresh()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model so that the embedding of each text is only ever computed once.
+
+    Keeps hit/miss counters to check how effective the cache is.
+    """
+
+    def __init__(self, embeddings: Embeddings, store: EmbeddingStore):
+        self.embeddings = embeddings
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model(self) -> str:
+        """Name of the model producing the embeddings."""
+        return getattr(self.embeddings, "model", type(self.embeddings).__name__)
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return sha256(text.encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts):
+        keys = [self.text_hash(text) for text in texts]
+        vectors = self.store.get(keys)
+        missing = {keys[i]: texts[i] for i, vec in enumerate(vectors) if vec is None}
+        self.hits += len(texts) - sum(vec is None for vec in vectors)
+        self.misses += len(missing)
+
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.store.put(list(missing.keys()), new_vectors)
+            new_vectors = dict(zip(missing.keys(), new_vectors))
+            vectors = [
+                new_vectors[key] if vec is None else vec for key, vec in zip(keys, vectors)
+            ]
+
+        return [np.asarray(vec, dtype=np.float32).tolist() for vec in vectors]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
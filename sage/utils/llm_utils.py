@@ -1,9 +1,16 @@
 """Util functions to handle LLMs"""
 import os
+import json
+import sqlite3
+import threading
+import time
 from dataclasses import dataclass, field
-from typing import Dict, Any, List, Type
+from hashlib import sha256
+from typing import Dict, Any, List, Optional, Type
 import datetime
 
+import langchain
+from langchain.cache import BaseCache
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import Ollama
 from langchain.llms.base import BaseLLM
@@ -11,7 +18,115 @@ from langchain import HuggingFaceTextGenInference
 from langchain.schema.messages import HumanMessage
 from langchain.chat_models import ChatAnthropic
 
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema import Generation
+
 from sage.base import BaseConfig
+from sage.utils.common import SMARTHOME_ROOT
+
+
+class LRUSQLiteCache(BaseCache):
+    """
+    On-disk LLM response cache with a bounded number of entries.
+
+    Entries are keyed on the hash of the prompt and the llm string (langchain serializes the
+    model name, temperature, stop sequences, etc. into it). When the cache grows beyond
+    max_entries, the least recently used entries are evicted. SQLite is used so that the cache
+    can be shared by the coordinator, the trigger server and the test runner processes.
+    """
+
+    def __init__(self, database_path: str, max_entries: int = 10000):
+        self.database_path = database_path
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(database_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(database_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return sha256(json.dumps([llm_string, prompt]).encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list[Generation]]:
+        """Look up based on prompt and llm_string."""
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+
+        generations = []
+
+        for gen in json.loads(row[0]):
+            try:
+                generations.append(loads(gen))
+            except Exception:
+                generations.append(Generation(text=gen))
+
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: list[Generation]) -> None:
+        """Update cache based on prompt and llm_string, evicting the LRU entries if needed."""
+        key = self._key(prompt, llm_string)
+        response = json.dumps([dumps(gen) for gen in return_val])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, last_access) VALUES (?, ?, ?)",
+                (key, response, time.time()),
+            )
+            (n_entries,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    """
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?
+                    )
+                    """,
+                    (n_entries - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        """Clear cache."""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+
+def setup_llm_cache(database_path: str, max_entries: int) -> LRUSQLiteCache:
+    """
+    Install the process-wide langchain LLM cache, reusing it if it already points to database_path.
+    """
+    cache = langchain.llm_cache
+
+    if not isinstance(cache, LRUSQLiteCache) or cache.database_path != database_path:
+        cache = LRUSQLiteCache(database_path, max_entries=max_entries)
+        langchain.llm_cache = cache
+    cache.max_entries = max_entries
+
+    return cache
 
 
 @dataclass
@@ -20,9 +135,20 @@ class LLMConfig(BaseConfig):
 
     _target: Type = None
 
+    # Cache the responses of the llm on disk. Set to False to always query the model.
+    cache: bool = True
+    cache_path: str = os.path.join(SMARTHOME_ROOT, "cache", "llm_cache.db")
+    cache_max_entries: int = 10000
+
+    def setup_cache(self) -> None:
+        """Make sure the shared response cache is installed if this config uses it."""
+        if self.cache:
+            setup_llm_cache(self.cache_path, self.cache_max_entries)
+
     def instantiate(self, **kwargs):
         kwargs.pop("global_config", None)  # 👈 加这一行，防止重复传 global_config
-        return self._target(**kwargs)
+        self.setup_cache()
+        return self._target(cache=self.cache, **kwargs)
 
 
 @dataclass
@@ -76,9 +202,10 @@ class OllamaConfig(LLMConfig):
         kwargs = vars(self).copy()
         kwargs.pop("_target")
         kwargs["model"] = kwargs.pop("model_name")
+        self.setup_cache()
 
         # ✅ 只传入 Ollama 支持的字段
-        allowed_keys = {"model", "temperature"}
+        allowed_keys = {"model", "temperature", "cache"}
         filtered_kwargs = {k: v for k, v in kwargs.items() if k in allowed_keys}
 
         return self._target(**filtered_kwargs)
@@ -0,0 +1,79 @@
+"""
+Client side of the trigger servers.
+"""
+import threading
+import time
+from collections import deque
+from typing import Any
+from typing import Optional
+
+import requests
+
+# how long a single long-poll request waits for, in seconds
+LONG_POLL_WAIT = 30.0
+
+# guards the state below, notified when a long-poll request ends
+_condition = threading.Condition()
+# url -> triggers received and not returned yet
+_received = {}
+# url -> error of the last long-poll request, raised to the caller
+_errors = {}
+# urls with a long-poll request in flight
+_polling = set()
+
+
+def _long_poll(url: str, wait: float) -> None:
+    trigger, error = None, None
+
+    try:
+        trigger = requests.get(
+            url + "/wait_triggers", params={"timeout": wait}, timeout=wait + 10
+        ).json()
+    except Exception as e:
+        error = e
+
+    with _condition:
+        _polling.discard(url)
+
+        if error is not None:
+            _errors[url] = error
+        elif trigger:
+            _received.setdefault(url, deque()).append(trigger)
+        _condition.notify_all()
+
+
+def wait_for_trigger(urls: list[str], timeout: Optional[float] = None) -> Optional[Any]:
+    """
+    Wait for the next trigger from any of the trigger servers, long-polling /wait_triggers on
+    all of them at once.
+
+    Args:
+        urls: base urls of the trigger servers
+        timeout: seconds to wait for before giving up (returning None). Waits forever if None.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+
+    with _condition:
+        while True:
+            for url in urls:
+                if url in _errors:
+                    raise _errors.pop(url)
+
+                if _received.get(url):
+                    trigger = _received[url].popleft()
+                    print("got trigger from %s" % url, trigger)
+
+                    return trigger
+            remaining = None if deadline is None else deadline - time.time()
+
+            if remaining is not None and remaining <= 0:
+                return None
+            wait = LONG_POLL_WAIT if remaining is None else min(LONG_POLL_WAIT, remaining)
+
+            for url in urls:
+                if url not in _polling:
+                    # triggers received by the requests still in flight when this returns are
+                    # kept for the next call
+                    _polling.add(url)
+                    threading.Thread(target=_long_poll, args=(url, wait), daemon=True).start()
+            _condition.wait(remaining)
@@ -5,17 +5,157 @@ The currently supported triggers are:
 - manual post to the server
 """
 import asyncio
+import builtins
+from collections import defaultdict
+import heapq
 import json
+import math
 import multiprocessing as mp
 from multiprocessing.connection import Connection
+from multiprocessing.connection import wait as mp_wait
 import os
+import re
+import signal
+import threading
 import time
-from typing import Callable, Optional, Any
+import traceback
+import uuid
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Any
 
 
 import aiohttp
 from aiohttp import web
 
+from sage.smartthings.state_snapshot import DeviceStateSnapshot
+from sage.smartthings.state_snapshot import proxy_requests_modules
+from sage.utils.condition_store import default_condition_store_path
+from sage.utils.condition_store import get_condition_store
+
+# maximum time a /wait_triggers request is kept open, in seconds
+MAX_WAIT_TIMEOUT = 300
+# consumer of the requests which do not specify one
+DEFAULT_CONSUMER = "default"
+# consumers which have not read the queue for this long (in seconds) are forgotten
+CONSUMER_TTL = 600
+# extra time given to a condition worker before it is considered stuck, in seconds
+WORKER_GRACE_PERIOD = 5
+GUID_RE = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+
+class TriggerQueue:
+    """
+    Bounded queue of triggers, which several consumers can read independently.
+
+    Each trigger gets a sequence number, and each consumer a cursor: the sequence number of the
+    next trigger it will read. Consumers are registered when they first read the queue, starting
+    with the triggers still in it, and forgotten when they have not read it for consumer_ttl
+    seconds. Triggers read by every registered consumer are dropped. When the queue is full, the
+    oldest trigger is dropped anyway, which counts as an overflow if a consumer had not read it.
+    """
+
+    def __init__(self, capacity: int = 1000, consumer_ttl: float = CONSUMER_TTL):
+        self.capacity = capacity
+        self.consumer_ttl = consumer_ttl
+        # sequence number -> trigger, for first_seq <= seq < next_seq
+        self.entries = {}
+        self.first_seq = 0
+        self.next_seq = 0
+        # consumer -> sequence number of the next trigger to read
+        self.cursors = {}
+        # consumer -> time.monotonic() of its last read
+        self.last_read = {}
+        self.overflows = 0
+
+    def __len__(self) -> int:
+        return self.next_seq - self.first_seq
+
+    def _cursor(self, consumer: str) -> int:
+        # unknown consumers start with the triggers still in the queue
+        return max(self.cursors.get(consumer, self.first_seq), self.first_seq)
+
+    def _touch(self, consumer: str) -> None:
+        """Register the consumer, or keep it registered."""
+        self.cursors[consumer] = self._cursor(consumer)
+        self.last_read[consumer] = time.monotonic()
+
+    def _expire(self) -> None:
+        """Forget the consumers which stopped reading, and drop what only they had to read."""
+        now = time.monotonic()
+
+        for consumer, last_read in list(self.last_read.items()):
+            if now - last_read > self.consumer_ttl:
+                del self.last_read[consumer]
+                del self.cursors[consumer]
+        self._trim()
+
+    def _trim(self) -> None:
+        """Drop the triggers read by every consumer."""
+        if not self.cursors:
+            # kept for the consumers to come
+            return
+        read_by_all = min(self.next_seq, *self.cursors.values())
+
+        while self.first_seq < read_by_all:
+            del self.entries[self.first_seq]
+            self.first_seq += 1
+
+    def append(self, trigger: Any) -> None:
+        self.entries[self.next_seq] = trigger
+        self.next_seq += 1
+
+        if len(self) > self.capacity:
+            self._expire()
+
+        if len(self) > self.capacity:
+            if any(cursor <= self.first_seq for cursor in self.cursors.values()):
+                self.overflows += 1
+            del self.entries[self.first_seq]
+            self.first_seq += 1
+
+    def pending(self, consumer: str = DEFAULT_CONSUMER) -> int:
+        """Number of triggers the consumer has not read yet."""
+        return self.next_seq - self._cursor(consumer)
+
+    def read(self, consumer: str = DEFAULT_CONSUMER, max_n: int = 1) -> list[tuple[int, Any]]:
+        """The next (at most max_n) (sequence number, trigger) unread by the consumer."""
+        self._touch(consumer)
+        start = self._cursor(consumer)
+        stop = min(self.next_seq, start + max_n)
+
+        return [(seq, self.entries[seq]) for seq in range(start, stop)]
+
+    def ack(self, consumer: str, seq: int) -> None:
+        """Mark the triggers up to seq (included) as read by the consumer."""
+        self._touch(consumer)
+        self.cursors[consumer] = max(self._cursor(consumer), seq + 1)
+        self._expire()
+
+    def pop(self, consumer: str = DEFAULT_CONSUMER, max_n: int = 1) -> list[Any]:
+        """Read the next triggers and mark them as read."""
+        entries = self.read(consumer, max_n)
+
+        if entries:
+            self.ack(consumer, entries[-1][0])
+
+        return [trigger for _, trigger in entries]
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.first_seq = self.next_seq
+
+    def stats(self) -> dict:
+        self._expire()
+
+        return {
+            "depth": len(self),
+            "capacity": self.capacity,
+            "total": self.next_seq,
+            "overflows": self.overflows,
+            "pending": {consumer: self.pending(consumer) for consumer in self.cursors},
+        }
+
 
 class BaseTriggerServer:
     """
@@ -28,6 +168,7 @@ class BaseTriggerServer:
         poller_args: Optional[list] = None,
         host: str = "0.0.0.0",
         port: int = 6789,
+        queue_capacity: int = 1000,
     ):
         """
         Args:
@@ -37,46 +178,197 @@ class BaseTriggerServer:
             poller_args: arguments that will be passed to poller_fn
             host: ip address to run server on
             port: port to run server on
+            queue_capacity: maximum number of triggers kept for the consumers
         """
 
         self.host = host
         self.port = port
         self.poller_fn = poller_fn
         self.poller_args = poller_args or tuple()
-        self.triggers = []
+        self.triggers = TriggerQueue(queue_capacity)
         self.process = None
+        # futures of the requests waiting for a trigger
+        self._waiters = set()
+        # consumer -> lock held while sending it triggers
+        self._send_locks = defaultdict(asyncio.Lock)
+
+    def add_trigger(self, trigger: Any) -> None:
+        """
+        Queue a trigger and wake up the requests waiting for one.
+        """
+        self.triggers.append(trigger)
+
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def _wait_for_triggers(self, consumer: str, timeout: float) -> None:
+        """
+        Wait up to timeout seconds for the consumer to have an unread trigger.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while not self.triggers.pending(consumer):
+            remaining = deadline - loop.time()
+
+            if remaining <= 0:
+                return
+            waiter = loop.create_future()
+            self._waiters.add(waiter)
+
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiters.discard(waiter)
+
+    async def _send_triggers(self, request: web.Request) -> web.StreamResponse:
+        """
+        Send the next triggers of the consumer of the request, and mark them as read once the
+        response is written: the triggers of a client gone while waiting are not lost.
+
+        Without the max query parameter, answers with the next trigger (or [] if there is none).
+        With it, answers with a list of up to max triggers.
+        """
+        consumer = request.query.get("consumer", DEFAULT_CONSUMER)
+
+        if "max" in request.query:
+            try:
+                max_n = int(request.query["max"])
+            except ValueError:
+                max_n = 0
+
+            if max_n < 1:
+                return web.Response(
+                    text=json.dumps(["max should be a positive integer"]), status=400
+                )
+        else:
+            max_n = None
+
+        # concurrent requests of a consumer must not read the same triggers
+        async with self._send_locks[consumer]:
+            entries = self.triggers.read(consumer, max_n or 1)
+
+            if max_n is None:
+                out = entries[0][1] if entries else []
+            else:
+                out = [trigger for _, trigger in entries]
+            response = web.Response(text=json.dumps(out))
+            await response.prepare(request)
+            await response.write_eof()
+
+            if entries:
+                self.triggers.ack(consumer, entries[-1][0])
+
+        return response
 
     async def _check_triggers(self, request: web.Request) -> web.Response:
         """
         Function that is called to check if any triggers have been detected by pollers.
         """
+        return await self._send_triggers(request)
 
-        if self.triggers:
-            out = web.Response(text=json.dumps(self.triggers.pop(0)))
+    async def _wait_triggers(self, request: web.Request) -> web.Response:
+        """
+        Long-poll version of check_triggers: answers as soon as a trigger is available, or with
+        no trigger after the timeout (in seconds) given as query parameter.
+        """
+        try:
+            timeout = float(request.query.get("timeout", 30))
+        except ValueError:
+            timeout = math.nan
 
-            return out
-        out = web.Response(text=json.dumps([]))
+        if math.isnan(timeout):
+            return web.Response(text=json.dumps(["timeout should be a number"]), status=400)
+        timeout = min(max(timeout, 0), MAX_WAIT_TIMEOUT)
+        await self._wait_for_triggers(request.query.get("consumer", DEFAULT_CONSUMER), timeout)
 
-        return out
+        return await self._send_triggers(request)
+
+    async def _triggers_ws(self, request: web.Request) -> web.WebSocketResponse:
+        """
+        Stream the triggers over a websocket, as JSON messages.
+        """
+        consumer = request.query.get("consumer", DEFAULT_CONSUMER)
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        async def read_until_closed():
+            # close frames and disconnections of the client are only processed by receive
+            async for _ in ws:
+                pass
+
+        closed = asyncio.ensure_future(read_until_closed())
+        waiting = None
+
+        try:
+            while not closed.done():
+                waiting = asyncio.ensure_future(self._wait_for_triggers(consumer, 30))
+                await asyncio.wait([waiting, closed], return_when=asyncio.FIRST_COMPLETED)
+
+                if not waiting.done():
+                    break
+
+                for seq, trigger in self.triggers.read(consumer, max_n=100):
+                    if ws.closed:
+                        # the client left, the unsent triggers stay unread
+                        break
+
+                    try:
+                        await ws.send_json(trigger)
+                    except ConnectionResetError:
+                        break
+                    self.triggers.ack(consumer, seq)
+        finally:
+            # also when the handler itself is cancelled
+            closed.cancel()
+
+            if waiting is not None:
+                waiting.cancel()
+
+        return ws
+
+    async def _trigger_stats(self, request: web.Request) -> web.Response:
+        """
+        Queue depth, overflows and number of unread triggers per consumer.
+        """
+        return web.Response(text=json.dumps(self.triggers.stats()))
 
     async def _manual_trigger(self, request: web.Request) -> web.Response:
         """
         Allows users to post triggers directly to server for testing.
         """
         reqjson = await request.json()
-        self.triggers.append(reqjson)
+        self.add_trigger(reqjson)
 
         return web.Response(text=json.dumps([]))
 
-    async def poll_triggers(self):
+    def handle_poller_message(self, message: Any) -> None:
+        """
+        Handle something sent by the poller. By default, it is a trigger.
+        """
+        self.add_trigger(message)
+
+    def _read_pipe(self) -> None:
         """
-        Check whether the polling_fn has found anything
+        Event loop reader callback, called as soon as the poller sent something.
         """
+        try:
+            while self.parent_conn.poll():
+                self.handle_poller_message(self.parent_conn.recv())
+        except (EOFError, OSError):
+            # the poller process died
+            asyncio.get_running_loop().remove_reader(self.parent_conn.fileno())
 
-        while True:
-            if self.parent_conn.poll():
-                self.triggers.append(self.parent_conn.recv())
-            await asyncio.sleep(1)
+    async def poll_triggers(self):
+        """
+        Deliver whatever the polling_fn finds as soon as it finds it.
+        """
+        asyncio.get_running_loop().add_reader(self.parent_conn.fileno(), self._read_pipe)
+        await asyncio.Event().wait()
 
     def get_routes(self) -> list:
         """
@@ -85,6 +377,9 @@ class BaseTriggerServer:
 
         return [
             web.get("/check_triggers", self._check_triggers),
+            web.get("/wait_triggers", self._wait_triggers),
+            web.get("/triggers/ws", self._triggers_ws),
+            web.get("/trigger_stats", self._trigger_stats),
             web.post("/trigger_manually", self._manual_trigger),
         ]
 
@@ -129,6 +424,28 @@ class BaseTriggerServer:
         asyncio.run(self.main())
 
 
+class CompiledCode:
+    """
+    Code compiled once and run in a namespace of its own.
+
+    code_define (imports, function definitions, etc) is executed once, when the object is
+    created, and calling the object only evaluates the code_run expression.
+    """
+
+    def __init__(self, code_define: str, code_run: str):
+        """
+        Args:
+            code_define (str): the code that does imports, function definitions, etc
+            code_run (str): the one line whose result you want to output.
+        """
+        self.namespace = {"__name__": "__condition__", "__builtins__": builtins}
+        exec(compile(code_define, "<code_define>", "exec"), self.namespace)
+        self.entrypoint = compile(code_run.strip("\n").strip(), "<code_run>", "eval")
+
+    def __call__(self) -> Any:
+        return eval(self.entrypoint, self.namespace)
+
+
 def run_code(code_define: str, code_run: str) -> Any:
     """
     Run some code in a string and return the result
@@ -137,109 +454,694 @@ def run_code(code_define: str, code_run: str) -> Any:
         code_define (str): the code that does imports, function definitions, etc
         code_run (str): the one line whose result you want to output.
     """
-    # adding the wrapper function is needed to get the imports to work
-    # add indentation
-    code_define = "\n    ".join(code_define.split("\n"))
-    code_run = code_run.strip("\n")
-    wrapper_fn = """
-def wrapper():
-    %s
-
-    return %s
-""" % (
-        code_define,
-        code_run,
-    )
-    exec(wrapper_fn)
-    return eval("wrapper()")
+    return CompiledCode(code_define, code_run)()
 
 
-def check_conditions(condition_registry: list[dict], code_registry: dict[str, dict]):
+class ConditionTimeout(BaseException):
     """
-    Checks all conditions once.
+    Raised in condition code running for too long. Not an Exception, so that the `except Exception`
+    blocks of the condition code don't swallow it (like KeyboardInterrupt).
     """
-    for condition in condition_registry:
-        fn_name = condition["function_name"]
-        code = code_registry[fn_name]
-        status = run_code(code["code_define"], code["code_run"])
-        if code["last_result"] != status:
-            code["last_result"] = status
-            if status == condition["notify_when"]:
-                return condition
-    return None
+
+
+@contextmanager
+def time_limit(seconds: float):
+    """
+    Raise ConditionTimeout if the block runs for more than seconds.
+
+    Uses SIGALRM, so it only works in the main thread (elsewhere, there is no limit).
+    """
+    if not seconds or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise ConditionTimeout("condition check timed out after %.1fs" % seconds)
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class ConditionEvaluator:
+    """
+    Compiled code of some conditions, evaluated with a time limit per condition.
+    """
+
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        # condition id -> code compiled at registration
+        self.compiled = {}
+        # device statuses shared by the conditions checked in the same tick
+        self.snapshot = DeviceStateSnapshot()
+
+    def add(self, condition_id: str, code: dict) -> Optional[str]:
+        """Compile the code of a condition, returns the error if it did not compile."""
+        try:
+            self.compiled[condition_id] = CompiledCode(code["code_define"], code["code_run"])
+        except Exception:
+            return traceback.format_exc()
+        proxy_requests_modules(self.compiled[condition_id].namespace, self.snapshot)
+
+        return None
+
+    def remove(self, condition_id: str) -> None:
+        self.compiled.pop(condition_id, None)
+
+    def reset(self) -> None:
+        self.compiled.clear()
+
+    def evaluate(self, condition_ids: list[str]) -> Iterator[tuple[str, bool, Any]]:
+        """
+        Evaluate conditions. Yields (condition id, True, result) for the conditions that ran
+        and (condition id, False, error message) for the others.
+        """
+        self.snapshot.clear()
+
+        for condition_id in condition_ids:
+            if condition_id not in self.compiled:
+                yield condition_id, False, "the condition code did not compile"
+                continue
+
+            try:
+                with time_limit(self.timeout):
+                    result = self.compiled[condition_id]()
+            except (Exception, ConditionTimeout):
+                yield condition_id, False, traceback.format_exc()
+                continue
+
+            yield condition_id, True, result
+
+
+def condition_worker(conn: Connection, timeout: float) -> None:
+    """
+    Evaluates a shard of the conditions, in a worker process of the poller.
+
+    Receives add / remove / reset / check messages. Sends back ("compile_error", condition id,
+    error) for the added conditions whose code did not compile, and for each check message, one
+    ("result", condition id, ok, result or error) per condition, as they are evaluated.
+    """
+    evaluator = ConditionEvaluator(timeout)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # the poller is gone
+            return
+
+        if message["type"] == "add":
+            error = evaluator.add(message["condition_id"], message["code"])
+
+            if error is not None:
+                conn.send(("compile_error", message["condition_id"], error))
+        elif message["type"] == "remove":
+            evaluator.remove(message["condition_id"])
+        elif message["type"] == "reset":
+            evaluator.reset()
+        elif message["type"] == "check":
+            for result in evaluator.evaluate(message["condition_ids"]):
+                conn.send(("result",) + result)
+
+
+class ConditionWorker:
+    """
+    Handle on a condition_worker process, and the conditions assigned to it.
+    """
+
+    def __init__(self, ctx: Any, timeout: float):
+        self.ctx = ctx
+        self.timeout = timeout
+        # condition id -> code
+        self.codes = {}
+        # ids of the conditions sent for a check and not answered yet, in order
+        self.in_flight = []
+        # time.monotonic() of the last check sent to an idle worker, or of the last result
+        self.last_progress = time.monotonic()
+        self.start()
+
+    def start(self) -> None:
+        self.conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(
+            target=condition_worker, args=(child_conn, self.timeout), daemon=True
+        )
+        self.process.start()
+
+        for condition_id, code in self.codes.items():
+            self.conn.send({"type": "add", "condition_id": condition_id, "code": code})
+
+    def restart(self) -> list[str]:
+        """
+        Replace the process, e.g. because a condition is stuck in code SIGALRM can't interrupt.
+
+        Returns:
+            the ids of the conditions whose check was lost
+        """
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        lost, self.in_flight = self.in_flight, []
+        self.start()
+
+        return lost
+
+    def check(self, condition_ids: list[str]) -> None:
+        if not self.in_flight:
+            self.last_progress = time.monotonic()
+        self.in_flight.extend(condition_ids)
+        self.conn.send({"type": "check", "condition_ids": condition_ids})
+
+    def stuck_deadline(self) -> Optional[float]:
+        """time.monotonic() after which the worker is considered stuck, None if it is idle."""
+        if not self.in_flight:
+            return None
+
+        return self.last_progress + self.timeout + WORKER_GRACE_PERIOD
+
+    def add(self, condition_id: str, code: dict) -> None:
+        self.codes[condition_id] = code
+        self.conn.send({"type": "add", "condition_id": condition_id, "code": code})
+
+    def remove(self, condition_id: str) -> None:
+        if self.codes.pop(condition_id, None) is not None:
+            self.conn.send({"type": "remove", "condition_id": condition_id})
+
+    def reset(self) -> None:
+        self.codes.clear()
+        self.conn.send({"type": "reset"})
+
+
+def shard_key(condition_id: str, code: dict) -> str:
+    """
+    Conditions watching the same device go to the same worker, so that they share its device
+    state snapshot.
+    """
+    match = GUID_RE.search(code["code_define"])
+
+    return match.group(0) if match else condition_id
+
+
+class ConditionPoller:
+    """
+    State of the condition polling process.
+
+    Conditions are added and removed through messages from the server, so the process never
+    needs to be restarted. Each condition is checked on its own interval, and the result of its
+    last check is kept so that only transitions trigger notifications.
+
+    With n_workers > 0, the conditions are sharded over that many worker processes, so that a
+    slow condition only delays the conditions of its own shard: check_due sends the due
+    conditions to the workers, and their results are handled by receive as they arrive.
+    Otherwise, they are evaluated in the poller process, by check_due.
+    """
+
+    def __init__(
+        self,
+        default_interval: float = 10,
+        n_workers: int = 0,
+        timeout: float = 30,
+        idle_after: float = 300,
+        backoff_factor: float = 1.5,
+        max_backoff: float = 8,
+        recent_window: float = 120,
+        min_interval: float = 1,
+    ):
+        """
+        Args:
+            default_interval: seconds between checks of the conditions which don't specify one
+            n_workers: number of worker processes evaluating the conditions (0 to do it in-process)
+            timeout: maximum time a single condition check can take, in seconds
+            idle_after: seconds without a change of result after which checks are spaced out
+            backoff_factor: interval multiplier applied at each check of an idle condition
+            max_backoff: idle conditions are checked at least every max_backoff intervals
+            recent_window: for this many seconds after a change of result, the condition is
+                checked twice as often
+            min_interval: tightening never goes below this interval, in seconds
+        """
+        self.default_interval = default_interval
+        self.timeout = timeout
+        self.idle_after = idle_after
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.recent_window = recent_window
+        self.min_interval = min_interval
+        # condition id -> condition, as sent by the NotifyOnConditionTool
+        self.conditions = {}
+        # function name -> code_define, code_run and last_result
+        self.codes = {}
+        # condition id -> result of the last check
+        self.last_results = {}
+        # condition id -> time.monotonic() of the next check
+        self.next_due = {}
+        # heap of (next due time, condition id). Entries not matching next_due are stale
+        self.schedule = []
+        # condition id -> current interval between checks
+        self.intervals = {}
+        # condition id -> time.monotonic() of the last change of result
+        self.last_change = {}
+        # (condition id, error) of the conditions dropped because their code did not compile,
+        # not reported to the server yet
+        self.compile_errors = []
+
+        if n_workers > 0:
+            ctx = mp.get_context("spawn")
+            self.workers = [ConditionWorker(ctx, timeout) for _ in range(n_workers)]
+            # condition id -> worker evaluating it
+            self.assignments = {}
+        else:
+            self.workers = []
+            self.evaluator = ConditionEvaluator(timeout)
+
+    def interval(self, condition: dict) -> float:
+        """Base interval of a condition: the one it asked for, or the default."""
+        return float(condition.get("interval") or self.default_interval)
+
+    def _schedule(self, condition_id: str, due: float) -> None:
+        self.next_due[condition_id] = due
+        heapq.heappush(self.schedule, (due, condition_id))
+
+    def _pop_stale(self) -> None:
+        """Drop the heap entries of removed or rescheduled conditions."""
+        while self.schedule and self.next_due.get(self.schedule[0][1]) != self.schedule[0][0]:
+            heapq.heappop(self.schedule)
+
+    def adapt_interval(self, condition_id: str, changed: bool, now: float) -> float:
+        """
+        Interval until the next check of a condition: shorter after a recent change of result,
+        growing while the result does not change for a long time.
+        """
+        base = self.interval(self.conditions[condition_id])
+
+        if changed:
+            self.last_change[condition_id] = now
+        since_change = now - self.last_change[condition_id]
+
+        if since_change < self.recent_window:
+            interval = max(base / 2, min(base, self.min_interval))
+        elif since_change > self.idle_after:
+            interval = min(
+                self.intervals[condition_id] * self.backoff_factor, base * self.max_backoff
+            )
+        else:
+            interval = base
+        self.intervals[condition_id] = interval
+
+        return interval
+
+    def add(self, condition_id: str, condition: dict, codes: dict[str, dict]) -> None:
+        self.codes.update(codes)
+        code = self.codes[condition["function_name"]]
+
+        if self.workers:
+            key = shard_key(condition_id, code)
+            worker = self.workers[zlib.crc32(key.encode()) % len(self.workers)]
+            self.assignments[condition_id] = worker
+            worker.add(condition_id, code)
+        self.conditions[condition_id] = condition
+        self.last_results[condition_id] = code["last_result"]
+        self.intervals[condition_id] = self.interval(condition)
+        # registration does not count as a change, the condition starts at its base interval
+        self.last_change[condition_id] = time.monotonic() - self.recent_window
+        self._schedule(condition_id, time.monotonic())
+
+        if not self.workers:
+            error = self.evaluator.add(condition_id, code)
+
+            if error is not None:
+                self._compile_failed(condition_id, error)
+
+    def _compile_failed(self, condition_id: str, error: str) -> None:
+        """Drop a condition whose code did not compile, and report it to the server."""
+        print("Removing condition %s, its code did not compile:\n%s" % (condition_id, error))
+        self.remove(condition_id)
+        self.compile_errors.append((condition_id, error))
+
+    def remove(self, condition_id: str) -> None:
+        self.conditions.pop(condition_id, None)
+        self.last_results.pop(condition_id, None)
+        self.next_due.pop(condition_id, None)
+        self.intervals.pop(condition_id, None)
+        self.last_change.pop(condition_id, None)
+
+        if self.workers:
+            worker = self.assignments.pop(condition_id, None)
+
+            if worker is not None:
+                worker.remove(condition_id)
+        else:
+            self.evaluator.remove(condition_id)
+
+    def reset(self) -> None:
+        self.conditions.clear()
+        self.codes.clear()
+        self.last_results.clear()
+        self.next_due.clear()
+        self.schedule.clear()
+        self.intervals.clear()
+        self.last_change.clear()
+
+        if self.workers:
+            self.assignments.clear()
+
+            for worker in self.workers:
+                worker.reset()
+        else:
+            self.evaluator.reset()
+
+    def handle_message(self, message: dict) -> None:
+        """Apply a message sent by the server."""
+        if message["type"] == "add":
+            self.add(message["condition_id"], message["condition"], message["code"])
+
+            # conditions restored from the store resume from their last known result
+            if "last_result" in message and message["condition_id"] in self.last_results:
+                self.last_results[message["condition_id"]] = message["last_result"]
+        elif message["type"] == "remove":
+            self.remove(message["condition_id"])
+        elif message["type"] == "reset":
+            self.reset()
+        else:
+            raise ValueError("Unknown message type: %s" % message["type"])
+
+    def time_to_next_check(self) -> Optional[float]:
+        """Seconds until the next condition is due, None if there are no conditions."""
+        self._pop_stale()
+        deadlines = [worker.stuck_deadline() for worker in self.workers]
+        deadlines = [d for d in deadlines if d is not None]
+
+        if self.schedule:
+            deadlines.append(self.schedule[0][0])
+
+        if not deadlines:
+            return None
+
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def worker_conns(self) -> list[Connection]:
+        return [worker.conn for worker in self.workers]
+
+    def _fail_lost_checks(self, worker: ConditionWorker, reason: str) -> None:
+        """Restart a worker. The condition it was on fails, the others are checked again."""
+        lost = worker.restart()
+        now = time.monotonic()
+
+        for i, condition_id in enumerate(lost):
+            if condition_id not in self.conditions:
+                continue
+
+            if i == 0:
+                self.handle_result(condition_id, False, reason)
+            else:
+                self._schedule(condition_id, now)
+
+    def receive(self, conn: Connection) -> list[tuple[str, Any, bool]]:
+        """
+        Handle a result sent by a worker. Returns the changes of result, like check_due.
+        """
+        worker = next((worker for worker in self.workers if worker.conn is conn), None)
+
+        if worker is None:
+            # connection of a worker restarted since
+            return []
+
+        try:
+            message = conn.recv()
+        except EOFError:
+            self._fail_lost_checks(worker, "the worker process died")
+            return []
+
+        if message[0] == "compile_error":
+            _, condition_id, error = message
+
+            if self.assignments.get(condition_id) is worker:
+                self._compile_failed(condition_id, error)
+
+            return []
+        _, condition_id, ok, status = message
+
+        if condition_id in worker.in_flight:
+            worker.in_flight.remove(condition_id)
+        worker.last_progress = time.monotonic()
+        change = self.handle_result(condition_id, ok, status)
+
+        return [] if change is None else [change]
+
+    def handle_result(
+        self, condition_id: str, ok: bool, status: Any
+    ) -> Optional[tuple[str, Any, bool]]:
+        """
+        Schedule the next check of a condition given the result of its check. Returns
+        (condition id, result, whether to notify) if the result changed, notifying if the
+        condition transitioned to the state it notifies on.
+        """
+        if condition_id not in self.conditions:
+            # removed while it was checked
+            return None
+        now = time.monotonic()
+
+        if not ok:
+            print("Error checking condition %s:\n%s" % (condition_id, status))
+            self._schedule(condition_id, now + self.intervals[condition_id])
+            return None
+        condition = self.conditions[condition_id]
+        changed = self.last_results[condition_id] != status
+        self._schedule(condition_id, now + self.adapt_interval(condition_id, changed, now))
+
+        if not changed:
+            return None
+        self.last_results[condition_id] = status
+
+        return condition_id, status, status == condition["notify_when"]
+
+    def check_due(self) -> list[tuple[str, Any, bool]]:
+        """
+        Check the conditions that are due. Returns the changes of result of the conditions
+        evaluated in-process, as (condition id, result, whether to notify). With workers, the
+        due conditions are only sent to them, and stuck workers are restarted.
+        """
+        now = time.monotonic()
+        due = []
+        changes = []
+
+        for worker in self.workers:
+            deadline = worker.stuck_deadline()
+
+            if deadline is not None and now > deadline:
+                self._fail_lost_checks(worker, "the condition check did not finish")
+        self._pop_stale()
+
+        while self.schedule and self.schedule[0][0] <= now:
+            _, condition_id = heapq.heappop(self.schedule)
+            # not scheduled again until its result is known
+            del self.next_due[condition_id]
+            due.append(condition_id)
+            self._pop_stale()
+
+        if self.workers:
+            # worker -> ids of the due conditions it evaluates, in order
+            batches = {}
+
+            for condition_id in due:
+                batches.setdefault(self.assignments[condition_id], []).append(condition_id)
+
+            for worker, condition_ids in batches.items():
+                worker.check(condition_ids)
+
+            return changes
+
+        for condition_id, ok, status in self.evaluator.evaluate(due):
+            change = self.handle_result(condition_id, ok, status)
+
+            if change is not None:
+                changes.append(change)
+
+        return changes
 
 
 def condition_poller(
-    conn: Connection, condition_registry: list[dict], code_registry: dict[str, dict]
+    conn: Connection,
+    registrations: list[dict],
+    default_interval: float = 10,
+    n_workers: int = 0,
+    timeout: float = 30,
 ):
     """
     Polls the registered conditions and runs the associated code.
-    Intended to be run in subprocess. Communicates with the main process using conn.
+    Intended to be run in subprocess. Communicates with the main process using conn: it receives
+    add / remove / reset messages and sends back every change of result of the conditions,
+    with whether it triggers them, and the conditions dropped because their code did not
+    compile.
+
+    Args:
+        registrations: add messages for the conditions registered before the poller started
+        default_interval: seconds between checks of the conditions which don't specify one
+        n_workers: number of worker processes evaluating the conditions (0 to do it in-process)
+        timeout: maximum time a single condition check can take, in seconds
     """
+    poller = ConditionPoller(default_interval, n_workers=n_workers, timeout=timeout)
+
+    for message in registrations:
+        poller.handle_message(message)
+
     while True:
-        triggered_condition = check_conditions(condition_registry, code_registry)
-        if triggered_condition:
-            command = triggered_condition["action_description"]
-            user = triggered_condition["user_name"]
+        # sleep until the next condition is due, waking up for messages from the server and
+        # results from the workers
+        changes = []
+
+        for ready in mp_wait([conn] + poller.worker_conns(), poller.time_to_next_check()):
+            if ready is not conn:
+                changes.extend(poller.receive(ready))
+                continue
+
+            try:
+                poller.handle_message(conn.recv())
+            except EOFError:
+                # the server is gone
+                return
+        changes.extend(poller.check_due())
+
+        for condition_id, status, trigger in changes:
+            if condition_id not in poller.conditions:
+                # removed by a message handled after it was checked
+                continue
+            condition = poller.conditions[condition_id]
             conn.send(
-                {"command": command, "user": user, "conditions": condition_registry}
+                {
+                    "command": condition["action_description"],
+                    "user": condition["user_name"],
+                    "condition_id": condition_id,
+                    "result": status,
+                    "trigger": trigger,
+                }
             )
-        time.sleep(10)  # configure this for demo or whatever
+
+        for condition_id, error in poller.compile_errors:
+            conn.send({"condition_id": condition_id, "error": error})
+        poller.compile_errors.clear()
 
 
 class ConditionTriggerServer(BaseTriggerServer):
     """
     Trigger server where python code can be registered and run until a condition is met.
+
+    Conditions are persisted in a ConditionStore and restored when the server starts.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        store_path: str = None,
+        default_interval: float = 10,
+        n_workers: int = 4,
+        condition_timeout: float = 30,
+        **kwargs,
+    ):
+        """
+        Args:
+            store_path: sqlite file where the conditions are persisted
+            default_interval: seconds between checks of the conditions which don't specify one
+            n_workers: number of processes evaluating the conditions
+            condition_timeout: maximum time a single condition check can take, in seconds
+        """
         super().__init__(*args, **kwargs)
-        self.conditions = []
-        self.codes = {}
-        self.poller_args = (self.conditions, self.codes)
+        self.store = get_condition_store(store_path or default_condition_store_path())
+        registrations = self.store.load()
+        # condition id -> condition
+        self.conditions = {cid: r["condition"] for cid, r in registrations.items()}
+        self.codes = {
+            r["condition"]["function_name"]: r["code"] for r in registrations.values()
+        }
+        self.poller_args = (
+            [
+                dict(
+                    self._add_message(cid, r["condition"], r["code"]),
+                    last_result=r["last_result"],
+                )
+                for cid, r in registrations.items()
+            ],
+            default_interval,
+            n_workers,
+            condition_timeout,
+        )
+
+    @staticmethod
+    def _add_message(condition_id: str, condition: dict, code: dict) -> dict:
+        return {
+            "type": "add",
+            "condition_id": condition_id,
+            "condition": condition,
+            "code": {condition["function_name"]: code},
+        }
+
+    def handle_poller_message(self, message: dict) -> None:
+        if "error" in message:
+            # the code of the condition did not compile, the poller dropped it
+            if self.conditions.pop(message["condition_id"], None) is not None:
+                self.store.remove_condition(message["condition_id"])
+            return
+
+        # every change is persisted, so that a restart resumes from the actual last result
+        self.store.record_result(message["condition_id"], message["result"])
+
+        if message["trigger"]:
+            self.add_trigger({"user": message["user"], "command": message["command"]})
 
     async def _add_condition(self, request: web.Request) -> web.Response:
         """
         Add a condition to be monitored by the server.
         """
         reqjson = await request.json()
-        if "code" in reqjson:
-            self.codes.update(reqjson["code"])
-        self.conditions.append(reqjson["condition"])
-        self.poller_args = (self.conditions, self.codes)
-        # restart the poller process with the new conditions
-        self.run_process()
-        out = web.Response(text=json.dumps(["got it"]))
+        condition = reqjson["condition"]
+        fn_name = condition["function_name"]
+        code = reqjson.get("code", {}).get(fn_name) or self.codes.get(fn_name)
+
+        if code is None:
+            code = self.store.get_code(fn_name)
+
+        if code is None:
+            return web.Response(text=json.dumps(["unknown function"]), status=400)
+        condition_id, created = self.store.add_condition(condition, code)
+
+        if created:
+            self.codes[fn_name] = code
+            self.conditions[condition_id] = condition
+            self.parent_conn.send(self._add_message(condition_id, condition, code))
+        out = web.Response(text=json.dumps(["got it", condition_id]))
         return out
 
-    async def _reset(self, request: web.Request) -> web.Response:
+    async def _remove_condition(self, request: web.Request) -> web.Response:
         """
-        Wipe out all conditions.
+        Stop monitoring a condition.
         """
-        self.conditions = []
-        self.codes = {}
-        self.poller_args = (self.conditions, self.codes)
-        self.triggers = []
-        return web.Response(text=json.dumps(["reset done"]))
+        reqjson = await request.json()
+        condition_id = reqjson["condition_id"]
 
-    async def poll_triggers(self):
+        if self.conditions.pop(condition_id, None) is None:
+            return web.Response(text=json.dumps(["unknown condition"]), status=404)
+        self.store.remove_condition(condition_id)
+        self.parent_conn.send({"type": "remove", "condition_id": condition_id})
+
+        return web.Response(text=json.dumps(["removed"]))
+
+    async def _reset(self, request: web.Request) -> web.Response:
         """
-        Check if the polling function has found anything.
+        Wipe out all conditions.
         """
-        while True:
-            if self.parent_conn.poll():
-                trigger = self.parent_conn.recv()
-                trigger_out = {"user": trigger["user"], "command": trigger["command"]}
-                self.triggers.append(trigger_out)
-                # We only want to trigger on transitions, so we need to keep track of how
-                # the condition status evolves. This means we need to synchronize the processes,
-                # because the polling process will get restarted when new conditions are added.
-                self.conditions = trigger["conditions"]
-            await asyncio.sleep(1)
+        self.conditions.clear()
+        self.codes.clear()
+        self.store.reset()
+        self.parent_conn.send({"type": "reset"})
+        self.triggers.clear()
+        return web.Response(text=json.dumps(["reset done"]))
 
     def get_routes(self) -> list:
         return super().get_routes() + [
             web.post("/add_condition", self._add_condition),
+            web.post("/remove_condition", self._remove_condition),
             web.get("/reset", self._reset),
         ]
 
@@ -250,7 +1152,12 @@ def run_server():
     """
     url = os.environ["TRIGGER_SERVER_URL"]
     host, port = url.split(":")
-    server = ConditionTriggerServer(condition_poller, host=host, port=port)
+    server = ConditionTriggerServer(
+        condition_poller,
+        host=host,
+        port=port,
+        n_workers=int(os.getenv("CONDITION_WORKERS", 4)),
+    )
     asyncio.run(server.main())
 
 